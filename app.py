@@ -1,29 +1,26 @@
-import os
-import sys
 import time
-import wave
+import uuid
+import queue
 import readline  # keep for arrow keys in input()
-import tempfile
 import argparse
 import threading
-from statistics import mean
-from typing import Optional
-from multiprocessing import Process
 
-import pyaudio
-import keyboard
 from termcolor import colored
-from textual import on, work
-from textual.validation import Length
-from textual.app import App, ComposeResult
-from textual.widgets import Header, Footer
-from textual.widgets import Input, RichLog, LoadingIndicator, Button, Sparkline
 
-from service.base import ServerBase
-from service.action import ActionServer, ActionClient
-from service.language_model import LanguageModelServer, LanguageModelClient
-from service.speech2text import Speech2TextServer, Speech2TextClient
-from service.text2speech import EdgettsServer, Pyttsx3Server
+from service import trace
+from service.audio import convert_pcm16, open_input_stream
+from service.action import ActionClient
+from service.language_model import LanguageModelClient
+from service.speech2text import Speech2TextClient
+from service.launcher import start_services, wait_for_services
+
+
+def ip_port(value):
+    ip, _, port = value.rpartition(':')
+    try:
+        return ip, int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not IP:PORT")
 
 
 def config():
@@ -61,6 +58,39 @@ def config():
                 (valid values: pyttsx3, edge-tts)",
     )
 
+    parser.add_argument(
+        "--audio.rate",
+        default=16000,
+        type=int,
+        dest="audio_rate",
+        help="The sample rate of the recorded audio sent to speech-to-text",
+    )
+
+    parser.add_argument(
+        "--audio.channels",
+        default=1,
+        type=int,
+        dest="audio_channels",
+        help="The number of channels of the recorded audio",
+    )
+
+    parser.add_argument(
+        "--tts.cache-dir",
+        default="cache/text_to_speech/",
+        dest="tts_cache_dir",
+        help="The directory to cache the synthesized speech",
+    )
+
+    parser.add_argument(
+        "--openseeface.targets",
+        default=[("127.0.0.1", 11573)],
+        type=ip_port,
+        nargs="+",
+        dest="openseeface_targets",
+        help="The IP:PORT of every OpenSeeFace receiver, e.g. VSeeFace, \
+                to drive the avatar on",
+    )
+
     parser.add_argument(
         "--stt.model-dir",
         default="model/speech_to_text/",
@@ -75,75 +105,92 @@ def config():
         help="The directory to store the language models",
     )
 
-    args = parser.parse_args()
-
-    print(colored("======== Application Configuration ========", 'green'))
-    for argname, argvalue in vars(args).items():
-        print(colored(f"{argname}:\t\t{argvalue}", 'green'))
-    return args
-
-
-def run_server(ServerClass: ServerBase,
-               log_redirect_to: Optional[str],
-               **kwargs):
-    if log_redirect_to == "stdout":
-        sys.stdout = sys.__stdout__
-    elif log_redirect_to is None:
-        sys.stdout = None
-    else:
-        sys.stdout = sys.__stdout__
-
-    server = ServerClass(**kwargs)
-    server.connect()
-    server.run()
+    parser.add_argument(
+        "--lm.cache",
+        action="store_true",
+        dest="lm_cache",
+        help="Replay the answers to prompts asked before in the same context",
+    )
 
+    parser.add_argument(
+        "--lm.cache-file",
+        default="cache/language_model/responses.json",
+        dest="lm_cache_file",
+        help="The file to keep the cached answers in across restarts",
+    )
 
-def start_server_process(ServerClass: ServerBase,
-                         log_redirect_to,
-                         **kwargs):
-    proc_server = Process(
-        target=run_server,
-        args=[ServerClass, log_redirect_to],
-        kwargs=kwargs
+    parser.add_argument(
+        "--lm.cache-ttl",
+        default=None,
+        type=float,
+        dest="lm_cache_ttl",
+        help="Seconds after which a cached answer is generated again",
     )
-    proc_server.daemon = True
-    proc_server.start()
-    return proc_server
 
+    parser.add_argument(
+        "--lm.context-tokens",
+        default=1536,
+        type=int,
+        dest="lm_context_tokens",
+        help="The number of tokens a chat session may take of the context",
+    )
 
-def start_services(app_cfg):
-    log_redirect_to = \
-        None if app_cfg.noecho_server_log else "stdout"
+    parser.add_argument(
+        "--lm.truncation",
+        default="window",
+        choices=["window", "summary"],
+        dest="lm_truncation",
+        help="Drop the oldest turns of a long chat, or summarize them \
+                (valid values: window, summary)",
+    )
 
-    start_server_process(
-        ActionServer, log_redirect_to,
+    parser.add_argument(
+        "--lm.session-dir",
+        default="cache/language_model/sessions/",
+        dest="lm_session_dir",
+        help="The directory to keep the idle chat sessions in",
     )
 
-    start_server_process(
-        LanguageModelServer, log_redirect_to,
-        model_dir=app_cfg.lm_model_dir
+    parser.add_argument(
+        "--lm.replicas",
+        default=1,
+        type=int,
+        dest="lm_replicas",
+        help="The number of model processes answering at the same time, \
+                each on its own share of the CPU cores",
     )
 
-    start_server_process(
-        Speech2TextServer, log_redirect_to,
-        model_dir=app_cfg.stt_model_dir
+    parser.add_argument(
+        "--lm.threads-per-replica",
+        default=None,
+        type=int,
+        dest="lm_threads_per_replica",
+        help="The number of threads every model uses \
+                (default: the cores of its replica)",
     )
 
-    if app_cfg.tts_engine == "pyttsx3":
-        TtsServerClass = Pyttsx3Server
-    elif app_cfg.tts_engine == "edge-tts":
-        TtsServerClass = EdgettsServer
-    else:
-        TtsServerClass = EdgettsServer
-    start_server_process(
-        TtsServerClass, log_redirect_to,
+    parser.add_argument(
+        "--trace-file",
+        default=None,
+        dest="trace_file",
+        help="Append the latency spans of every turn to this file \
+                as JSON lines",
     )
 
+    args = parser.parse_args()
+
+    print(colored("======== Application Configuration ========", 'green'))
+    for argname, argvalue in vars(args).items():
+        print(colored(f"{argname}:\t\t{argvalue}", 'green'))
+    return args
+
 
 class TalkyTalkyCLI:
     def __init__(self, app_cfg):
         self.app_cfg = app_cfg
-        start_services(self.app_cfg)
+        self.services = start_services(self.app_cfg)
+        trace.configure(self.app_cfg.trace_file)
+        self.tracer = trace.Tracer(self.__class__.__name__)
 
     def run(self):
         if self.app_cfg.user_input == "voice":
@@ -155,314 +202,145 @@ class TalkyTalkyCLI:
         language_model_client = LanguageModelClient()
         action_client = ActionClient()
 
-        language_model_client.connect()
-        action_client.connect()
+        wait_for_services(self.services, {
+            'language_model': language_model_client,
+            'action': action_client,
+        })
+        # the server keeps the chat history under this id, see SessionStore
+        language_model_client.use_session(uuid.uuid4().hex)
 
         print(colored("======== Type to Chat! ========", 'green'))
         while True:
             me = 'ME  >> '
             prompt = input(colored(me, 'red'))
             if len(prompt) > 0:
-                # get answer from the prompt
-                answer = language_model_client.get_answer(prompt)
-
-                her = 'BOT >> '
-                print(colored(her, 'green'), answer)
-                print('')
-
-                # make reaction to the answer
-                action_client.react_to(answer)
+                turn_id = self.begin_turn(language_model_client, action_client)
+                start = time.perf_counter()
+                # the avatar reads the answer aloud in the background while
+                # it is printed here, so the next prompt can be typed once
+                # the answer has been generated
+                tokens = queue.Queue()
+                action_client.react_to_async(iter(tokens.get, None), on_done=(
+                    lambda _, turn_id=turn_id, start=start:
+                    self.tracer.record('turn', turn_id, start)))
+                try:
+                    for token in self.print_answer(
+                            language_model_client.stream_answer(prompt)):
+                        tokens.put(token)
+                finally:
+                    tokens.put(None)
 
     def voice_interact(self):
+        # the recording libraries are only needed when talking
+        import pyaudio
+        import keyboard
+
         speech2text_client = Speech2TextClient()
         language_model_client = LanguageModelClient()
         action_client = ActionClient()
 
-        speech2text_client.connect()
-        language_model_client.connect()
-        action_client.connect()
+        wait_for_services(self.services, {
+            'speech2text': speech2text_client,
+            'language_model': language_model_client,
+            'action': action_client,
+        })
+        # the server keeps the chat history under this id, see SessionStore
+        language_model_client.use_session(uuid.uuid4().hex)
 
         # Constants for audio settings
-        FORMAT = pyaudio.paInt16
-        CHANNELS = 2
-        RATE = 44100
+        CHANNELS = self.app_cfg.audio_channels
+        RATE = self.app_cfg.audio_rate
         CHUNK = 1024
 
         audio = pyaudio.PyAudio()
-        stream = audio.open(format=FORMAT, channels=CHANNELS,
-                            rate=RATE, input=True,
-                            frames_per_buffer=CHUNK)
+        stream, capture_rate, capture_channels = open_input_stream(
+            audio, RATE, CHANNELS, CHUNK)
+        stream.stop_stream()
 
-        print(colored("======== Holding SPACE KEY to Record ========", 'green'))
-        frames = []
-        while True:
+        def record():
             stream.start_stream()
-            frames.clear()
-
-            # start recording if key is pressed
             while keyboard.is_pressed('space'):
                 data = stream.read(CHUNK)
-                frames.append(data)
                 # recording progress bar
                 print(colored('>', 'blue'), end='', flush=True)
-
+                yield convert_pcm16(data, capture_rate, capture_channels,
+                                    RATE, CHANNELS)
             stream.stop_stream()
+            print('')
 
-            # Save the recorded audio to a WAV file
-            if len(frames) > 0:
-                wav_fp, wav_path = tempfile.mkstemp()
-                wf = wave.open(wav_path, 'wb')
-                wf.setnchannels(CHANNELS)
-                wf.setsampwidth(audio.get_sample_size(FORMAT))
-                wf.setframerate(RATE)
-                wf.writeframes(b''.join(frames))
-                wf.close()
-
-                # speech to text
-                print('')
-                prompt = speech2text_client.get_text(wav_path)
-                os.close(wav_fp)
-                os.remove(wav_path)
-
-                # print my prompt words
-                me = 'ME  >> '
-                print(colored(me, 'red'), prompt)
-                if prompt == '[EMPTY SPEECH]':
-                    answer = "Sorry, I can't hear you clearly. Please try again."
-                else:
-                    # get answer from the prompt
-                    answer = language_model_client.get_answer(prompt)
-
-                her = 'BOT >> '
-                print(colored(her, 'green'), answer)
-                print('')
-
-                # make reaction to the answer
-                action_client.react_to(answer)
+        # holding SPACE while the bot answers interrupts it (barge-in)
+        def watch_barge_in(turn_id, answered):
+            while not answered.wait(0.05):
+                if keyboard.is_pressed('space'):
+                    self.cancel_turn(turn_id, language_model_client,
+                                     action_client)
+                    return
+
+        print(colored("======== Holding SPACE KEY to Record ========", 'green'))
+        while True:
+            # start recording if key is pressed
+            if keyboard.is_pressed('space'):
+                turn_id = self.begin_turn(speech2text_client,
+                                          language_model_client,
+                                          action_client)
+                with self.tracer.span('turn', turn_id):
+                    # speech to text while the user is still speaking
+                    prompt = speech2text_client.get_text_from_pcm_stream(
+                        record(), RATE, CHANNELS)
+
+                    # print my prompt words
+                    me = 'ME  >> '
+                    print(colored(me, 'red'), prompt)
+                    if prompt == '[EMPTY SPEECH]':
+                        answer = self.print_answer(
+                            ["Sorry, I can't hear you clearly. "
+                             "Please try again."])
+                    else:
+                        # get answer from the prompt
+                        answer = self.print_answer(
+                            language_model_client.stream_answer(prompt))
+
+                    # make reaction to the answer while it is being generated
+                    answered = threading.Event()
+                    threading.Thread(target=watch_barge_in,
+                                     args=(turn_id, answered),
+                                     daemon=True).start()
+                    action_client.react_to(answer)
+                    answered.set()
 
             time.sleep(0.1)
 
         stream.close()
         audio.terminate()
 
-
-class TalkyTalkyTUI(App):
-    CSS = '''
-Screen {
-    layout: vertical;
-    layers: below above;
-    align: center middle;
-}
-
-RichLog {
-    layer: below;
-    height: 0.7fr;
-    border: round darkgreen;
-    background: green 10%;
-    margin: 1;
-}
-
-RichLog:focus {
-    border: round green;
-    background: green 15%;
-}
-
-#prompt_box {
-    layer: below;
-    height: 0.2fr;
-    border: round darkblue;
-    background: blue 10%;
-    margin: 1;
-}
-
-#prompt_box:focus {
-    border: round blue;
-    background: blue 15%;
-}
-
-Button {
-    layer: below;
-    height: 0.1fr;
-    width: 1fr;
-    margin: 2;
-    min-height: 1;
-}
-
-#start_record {
-    display: block;
-}
-
-#stop_record {
-    display: none;
-}
-
-LoadingIndicator {
-    layer: above;
-    height: 10%;
-    width: 30%;
-    margin: 2;
-    padding: 1;
-    min-height: 3;
-    display: none;
-    content-align: center middle;
-}
-
-#processing_chat {
-    color: $accent;
-    border: $accent round;
-}
-
-#processing_record {
-    color: $warning;
-    border: $warning round;
-}
-
-Sparkline {
-    layer: above;
-    height: 10%;
-    width: 30%;
-    margin: 2;
-    padding: 1;
-    min-height: 3;
-    display: none;
-    border: $warning round;
-    content-align: center middle;
-}
-
-Sparkline > .sparkline--max-color {
-    color: $error;
-}
-
-Sparkline > .sparkline--min-color {
-    color: $warning;
-}
-'''
-
-    BINDINGS = [("d", "toggle_dark", "Toggle dark mode"),
-                ("q", "quit", "Quit")]
-
-    def __init__(self, app_cfg):
-        self.app_cfg = app_cfg
-        start_services(self.app_cfg)
-
-        self.speech2text_client = Speech2TextClient()
-        self.language_model_client = LanguageModelClient()
-        self.action_client = ActionClient()
-
-        self.speech2text_client.connect()
-        self.language_model_client.connect()
-        self.action_client.connect()
-
-        self.mutex_on_submit = threading.Lock()
-
-        self.is_recording = False
-        self.chunk = 1024
-        self.sample_format = pyaudio.paInt16
-        self.channels = 2
-        self.fs = 44100
-        self.audio = pyaudio.PyAudio()
-        self.stream = self.audio.open(format=self.sample_format,
-                                      channels=self.channels,
-                                      rate=self.fs,
-                                      frames_per_buffer=self.chunk,
-                                      input=True)
-        super().__init__()
-
-    def compose(self) -> ComposeResult:
-        yield Header()
-        yield Footer()
-        yield RichLog(wrap=True, highlight=True, markup=True)
-        yield Input(id="prompt_box",
-                    placeholder="Write your prompt here. Press ENTER to send.",
-                    validate_on=["changed", "submitted"],
-                    validators=[Length(minimum=1, failure_description="Your prompt must not be empty.")]).focus()
-        yield Button(label="SPEECH TO TEXT", id="start_record")
-        yield Button(label="FINISH SPEAKING", id="stop_record", variant='warning')
-        yield LoadingIndicator(id="processing_chat")
-        yield LoadingIndicator(id="processing_record")
-        yield Sparkline(data=[], summary_function=mean)
-
-    def action_toggle_dark(self) -> None:
-        """An action to toggle dark mode."""
-        self.dark = not self.dark
-
-    # TODO: After I add id="#prompt_box", input_box.action_submit() does not trigger submit_prompt(), why?
-    # @on(Input.Submitted, "#prompt_box")
-    @on(Input.Submitted)
-    @work(exclusive=True, thread=True)
-    def submit_prompt(self, event: Input.Submitted) -> None:
-        if self.mutex_on_submit.acquire(blocking=False):
-            if event.validation_result.is_valid:
-                loading_box = self.query_one("#processing_chat")
-                loading_box.display = True
-                chat_box = self.query_one(RichLog)
-
-                me = '[bold red]ME  >> [/bold red]'
-                her = '[bold green]BOT >> [/bold green]'
-                prompt = event.value
-                chat_box.write(me + prompt)
-                self.query_one("#prompt_box").value = ''
-
-                answer = self.language_model_client.get_answer(prompt)
-                chat_box.write(her + answer)
-
-                loading_box.display = False
-                self.action_client.react_to(answer)
-
-            self.mutex_on_submit.release()
-
-    @on(Button.Pressed, "#start_record")
-    @work(exclusive=True, thread=True)
-    async def start_record(self):
-        if not self.is_recording:
-            self.is_recording = True
-            self.query_one("#start_record").display = False
-            self.query_one("#stop_record").display = True
-
-            frames = []
-            sparkline = self.query_one(Sparkline)
-            self.stream.start_stream()
-            sparkline.display = True
-            while self.is_recording:
-                data = self.stream.read(self.chunk)
-                frames.append(data)
-                sparkline.data = data
-            self.stream.stop_stream()
-            sparkline.display = False
-
-            input_box = self.query_one("#prompt_box")
-            loading_box = self.query_one("#processing_record")
-            loading_box.display = True
-            if len(frames) > 0:
-                wav_fp, wav_path = tempfile.mkstemp()
-                wf = wave.open(wav_path, 'wb')
-                wf.setnchannels(self.channels)
-                wf.setsampwidth(self.audio.get_sample_size(self.sample_format))
-                wf.setframerate(self.fs)
-                wf.writeframes(b''.join(frames))
-                wf.close()
-
-                prompt = self.speech2text_client.get_text(wav_path)
-                input_box.value = prompt
-                os.close(wav_fp)
-                os.remove(wav_path)
-
-            loading_box.display = False
-            self.query_one("#stop_record").display = False
-            self.query_one("#start_record").display = True
-            input_box.focus()
-
-            await input_box.action_submit()
-
-    @on(Button.Pressed, "#stop_record")
-    def stop_record(self):
-        if self.is_recording:
-            self.is_recording = False
+    def begin_turn(self, *clients):
+        # every server records the spans of this turn under the same id
+        turn_id = trace.new_turn_id()
+        for client in clients:
+            client.begin_turn(turn_id)
+        return turn_id
+
+    def cancel_turn(self, turn_id, *clients):
+        # the action server passes it on to the text-to-speech server
+        for client in clients:
+            client.cancel(turn_id)
+        print(colored("[INTERRUPTED]", 'yellow'))
+
+    def print_answer(self, tokens):
+        her = 'BOT >> '
+        print(colored(her, 'green'), end=' ', flush=True)
+        # print the answer token by token as soon as it is generated
+        for token in tokens:
+            print(token, end='', flush=True)
+            yield token
+        print('\n')
 
 
 if __name__ == "__main__":
     app_cfg = config()
     if app_cfg.tui:
+        # textual is only loaded when the TUI is asked for
+        from tui import TalkyTalkyTUI
         app = TalkyTalkyTUI(app_cfg)
     else:
         app = TalkyTalkyCLI(app_cfg)
@@ -1,9 +1,17 @@
 import os
 import time
 import enum
+import queue
 import socket
+import struct
 import threading
-from service.base import ServerBase, ClientBase
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+from service.base import ServerBase, ClientBase, MessageType, ServiceError
+from service.audio import AUDIO_HEADER, pcm16_to_float32, downmix
+from service.openseeface import FRAME_LEN, Clip, encode, interpolate
+from service.openseeface import feature_offset
 from service.text2speech import Text2SpeechClient
 
 
@@ -12,60 +20,349 @@ class Action(enum.Enum):
     SPEAKING = 'speaking'
 
 
+# Counters of the frame scheduler: achieved fps, jitter and dropped frames
+class FrameStats:
+    def __init__(self, window=240):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.dropped = 0
+        # the recent frames only, so the numbers follow the current load
+        self.send_times = deque(maxlen=window)
+        self.jitters = deque(maxlen=window)
+
+    def record_sent(self, send_time, deadline):
+        with self.lock:
+            self.sent += 1
+            self.send_times.append(send_time)
+            self.jitters.append(send_time - deadline)
+
+    def record_dropped(self, count):
+        with self.lock:
+            self.dropped += count
+
+    def summary(self):
+        with self.lock:
+            fps = 0.0
+            if len(self.send_times) > 1:
+                duration = self.send_times[-1] - self.send_times[0]
+                if duration > 0:
+                    fps = (len(self.send_times) - 1) / duration
+            jitters = [abs(j) for j in self.jitters] or [0.0]
+            return {
+                'fps': round(fps, 2),
+                'jitter_mean_ms': round(1000 * sum(jitters) / len(jitters), 3),
+                'jitter_max_ms': round(1000 * max(jitters), 3),
+                'sent': self.sent,
+                'dropped': self.dropped,
+            }
+
+
+# Turns the audio being read aloud into the mouth openness of the avatar,
+# one value per frame from the loudness (RMS) of the frame's audio
+class LipSync:
+    def __init__(self, fps, silence_db=-50, loud_db=-15):
+        self.fps = fps
+        self.silence_db = silence_db
+        self.loud_db = loud_db
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = None
+            self.envelope = np.zeros(0, dtype=np.float32)
+            self.samples = np.zeros(0, dtype=np.float32)
+            self.window_len = 1
+            self.channels = 1
+
+    def start(self, rate, channels):
+        # a new sentence starts being played now
+        with self.lock:
+            self.start_time = time.monotonic()
+            self.envelope = np.zeros(0, dtype=np.float32)
+            self.samples = np.zeros(0, dtype=np.float32)
+            self.window_len = max(1, int(rate / self.fps))
+            self.channels = channels
+
+    def feed(self, pcm):
+        samples = downmix(
+            pcm16_to_float32(np.frombuffer(pcm, dtype='<i2')), self.channels)
+        with self.lock:
+            samples = np.concatenate((self.samples, samples))
+            num_windows = len(samples) // self.window_len
+            windows = samples[:num_windows * self.window_len].reshape(
+                num_windows, self.window_len)
+            self.samples = samples[num_windows * self.window_len:]
+
+            # map the loudness in dB linearly onto 0 (closed) .. 1 (open)
+            rms = np.sqrt(np.mean(np.square(windows), axis=1))
+            db = 20 * np.log10(np.maximum(rms, 1e-10))
+            mouth_open = np.clip((db - self.silence_db)
+                                 / (self.loud_db - self.silence_db), 0, 1)
+            self.envelope = np.concatenate(
+                (self.envelope, mouth_open.astype(np.float32)))
+
+    def mouth_open(self, now):
+        with self.lock:
+            # no audio, let the action clip move the mouth
+            if self.start_time is None:
+                return None
+            index = int((now - self.start_time) * self.fps)
+            # the mouth stays closed between the sentences
+            if index >= len(self.envelope):
+                return 0.0
+            return float(self.envelope[index])
+
+
+# Sends every frame to several OpenSeeFace receivers over one non-blocking
+# UDP socket. A receiver that can not take a frame right now gets it queued
+# instead of stalling the frame loop, the oldest queued frames are dropped.
+class FrameSender:
+    def __init__(self, targets, max_backlog=2):
+        self.targets = [tuple(target) for target in targets]
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.backlogs = {target: deque(maxlen=max_backlog)
+                         for target in self.targets}
+        self.counters = {target: {'sent': 0, 'errors': 0, 'dropped': 0}
+                         for target in self.targets}
+
+    def send(self, frame):
+        for target in self.targets:
+            backlog = self.backlogs[target]
+            # the queued frames go first, in order
+            while backlog and self._sendto(backlog[0], target):
+                backlog.popleft()
+            if backlog or not self._sendto(frame, target):
+                if len(backlog) == backlog.maxlen:
+                    self.counters[target]['dropped'] += 1
+                # the frame may be a reused buffer, so queue a copy
+                backlog.append(bytes(frame))
+
+    def summary(self):
+        return {f'{ip}:{port}': dict(self.counters[(ip, port)],
+                                     backlog=len(self.backlogs[(ip, port)]))
+                for ip, port in self.targets}
+
+    def close(self):
+        self.socket.close()
+
+    def _sendto(self, data, target):
+        try:
+            self.socket.sendto(data, target)
+        except BlockingIOError:
+            return False
+        except OSError:
+            # e.g. the receiver is not there, this frame is lost for it
+            self.counters[target]['errors'] += 1
+            return True
+        self.counters[target]['sent'] += 1
+        return True
+
+
+# An answer waiting in the ActionServer to be read aloud. The text of a
+# stream keeps arriving in chunks while the answers before it are read.
+class Utterance:
+    def __init__(self, conn, turn_id):
+        self.conn = conn
+        self.turn_id = turn_id
+        self.start = time.perf_counter()
+        self.text = None
+        # why the text could not be received
+        self.error = None
+        # the chunks of a text stream, None marks its end
+        self.chunks = queue.Queue()
+
+    def iter_chunks(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+
+
 class ActionClient(ClientBase):
     def __init__(self,
                  server_ip='127.0.0.1', server_port=12346, recv_buflen=4096):
 
         super().__init__(server_ip=server_ip, server_port=server_port,
                          recv_buflen=recv_buflen)
+        # the utterances waiting to be sent, and the futures waiting for
+        # their reactions, both in the order of react_to_async()
+        self.outbox = queue.Queue()
+        self.pending = deque()
+        self.pending_lock = threading.Lock()
+        self.connection_error = None
+        self.sender_thread = None
+        self.receiver_thread = None
+
+    # The turn id is sent along with the next utterance, as the text stream
+    # of the previous one may still be on its way to the server
+    def begin_turn(self, turn_id):
+        self.turn_id = turn_id
 
     def react_to(self, sentence):
-        self.socket.sendall(sentence.encode('utf-8'))
-        self.socket.recv(self.recv_buflen).decode('utf-8')
+        return self.react_to_async(sentence).result()
+
+    # Returns at once with a Future, which is done when the avatar has read
+    # the sentence aloud. The sentences are sent in order, so the next
+    # answer can be generated while the previous one is still being read.
+    # on_done(future) and the other callbacks of the future are called on
+    # the thread receiving the reactions.
+    def react_to_async(self, sentence, on_done=None):
+        future = Future()
+        if on_done:
+            future.add_done_callback(on_done)
+        with self.pending_lock:
+            if self.sender_thread is None:
+                self.sender_thread = threading.Thread(
+                    target=self._send_utterances)
+                self.sender_thread.daemon = True
+                self.sender_thread.start()
+                self.receiver_thread = threading.Thread(
+                    target=self._recv_reactions)
+                self.receiver_thread.daemon = True
+                self.receiver_thread.start()
+        self.outbox.put((self.turn_id, sentence, future))
+        return future
+
+    def _send_utterances(self):
+        sent_turn_id = None
+        while True:
+            turn_id, sentence, future = self.outbox.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self.pending_lock:
+                if self.connection_error:
+                    future.set_exception(self.connection_error)
+                    continue
+                self.pending.append(future)
+            try:
+                if turn_id and turn_id != sent_turn_id:
+                    self._send(MessageType.TRACE, turn_id)
+                    sent_turn_id = turn_id
+                if isinstance(sentence, str):
+                    self._send(MessageType.TEXT, sentence)
+                else:
+                    # a text stream, e.g. the tokens of LanguageModelClient
+                    self._send_stream(sentence)
+            except OSError as e:
+                # the receiver fails the pending futures as well
+                future.set_exception(e)
+            except Exception as e:
+                # the text stream broke off, end it so the server replies
+                # and the next sentence is not read as a part of it
+                future.set_exception(e)
+                try:
+                    self._send(MessageType.END)
+                except OSError:
+                    pass
+
+    def _recv_reactions(self):
+        try:
+            while True:
+                try:
+                    msg_type, payload = self._recv()
+                except ServiceError as e:
+                    # the reaction to this sentence failed
+                    result = e
+                else:
+                    if msg_type is not MessageType.STATUS:
+                        continue
+                    result = payload.decode('utf-8')
+                with self.pending_lock:
+                    future = self.pending.popleft()
+                if future.done():
+                    continue
+                if isinstance(result, ServiceError):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        except OSError as e:
+            self._client_log(f"Lost the connection to the server ({e})")
+            with self.pending_lock:
+                self.connection_error = e
+                futures = list(self.pending)
+                self.pending.clear()
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
 
 
 class ActionServer(ServerBase):
 
-    OPENSEEFACE_FRAME_LEN = 1785
+    OPENSEEFACE_FRAME_LEN = FRAME_LEN
+    OPENSEEFACE_MOUTH_OPEN = struct.Struct('<f')
+    OPENSEEFACE_MOUTH_OPEN_OFFSET = feature_offset('mouth_open')
     OPENSEEFACE_ACTION_DIR = r'action/openseeface/'
 
     def __init__(self,
                  action_fps: int = 24,
+                 transition_frames: int = 6,
                  tts_server_ip: str = '127.0.0.1',
                  tts_server_port: int = 12347,
                  openseeface_client_ip: str = '127.0.0.1',
                  openseeface_client_port: int = 11573,
+                 openseeface_targets: list = None,
                  ip: str = '127.0.0.1',
                  port: str = 12346,
-                 recv_buflen: int = 4096):
+                 recv_buflen: int = 4096,
+                 max_pending_utterances: int = 8):
 
         super().__init__(ip=ip, port=port, recv_buflen=recv_buflen)
 
         self.tts_client = Text2SpeechClient(tts_server_ip, tts_server_port)
+        # the answers are received on the request worker and read aloud one
+        # after another on the speaker thread, so a client may send its next
+        # answer while the previous one is still being read
+        self.utterances = queue.Queue(maxsize=max_pending_utterances)
+        self.speaker_thread = None
+        # the turn whose answer is being read aloud
+        self.speaking_turn = None
 
         # the role is in the idle state by default
         self.actor_state = Action.IDLE
+        self.actor_state_changed = threading.Condition()
         self.action_fps = action_fps
         self.action_daemon_thread = None
+        self.frame_stats = FrameStats()
+        self.lip_sync = LipSync(action_fps)
 
         self.openseeface_client_ip = openseeface_client_ip
         self.openseeface_client_port = openseeface_client_port
+        # the frames can be sent to several receivers, e.g. one VSeeFace
+        # per screen; by default there is only the openseeface client
+        if not openseeface_targets:
+            openseeface_targets = [(openseeface_client_ip,
+                                    openseeface_client_port)]
         # Openseeface uses UDP, so we init the socket here
-        self.openseeface_client_socket = socket.socket(
-            socket.AF_INET, socket.SOCK_DGRAM)
+        self.openseeface_sender = FrameSender(openseeface_targets)
         self.openseeface_actions = self._init_actions()
+        self.openseeface_decoded_actions = {
+            action: clip.decode()
+            for action, clip in self.openseeface_actions.items()}
+
+        # smoothstep weights of the cross-fade between two actions,
+        # computed once so a transition is only a few array operations
+        steps = np.arange(1, transition_frames + 1) / (transition_frames + 1)
+        self.transition_weights = steps * steps * (3 - 2 * steps)
 
     def __del__(self):
         super().__del__()
 
-        if self.openseeface_client_socket:
-            self.openseeface_client_socket.close()
+        if self.openseeface_sender:
+            self.openseeface_sender.close()
+        # the decoded views must go before the mapped clips are closed
+        self.openseeface_decoded_actions.clear()
+        for clip in self.openseeface_actions.values():
+            clip.close()
         if self.action_daemon_thread:
             self.action_daemon_thread.join()
 
     def connect(self, listen_timeout=1):
         super().connect(listen_timeout)
-        self.tts_client.connect()
+        # the TTS server is loaded in parallel, poll it a bit more often
+        self.tts_client.connect(wait_time=0.1)
 
     def run(self):
         self.action_daemon_thread = threading.Thread(
@@ -73,23 +370,108 @@ class ActionServer(ServerBase):
         self.action_daemon_thread.daemon = True
         self.action_daemon_thread.start()
 
-        # Communication loop
+        self.speaker_thread = threading.Thread(target=self._speaker)
+        self.speaker_thread.daemon = True
+        self.speaker_thread.start()
+
+        super().run()
+
+    def handle_request(self, conn, msg_type, payload):
+        # the turn id of the connection changes with the next answer, which
+        # may arrive before this one is read aloud
+        utterance = Utterance(conn, conn.turn_id)
+        # a broken text is replied to by the speaker thread as well, so the
+        # replies keep the order of the answers
+        if msg_type is MessageType.TOKEN:
+            # queue the text stream at once, so it is read as it arrives
+            self.utterances.put(utterance)
+            self._server_log(f"Received a text stream from {conn.address}")
+            try:
+                for chunk in conn.iter_stream(payload):
+                    utterance.chunks.put(chunk)
+            except UnicodeDecodeError as e:
+                utterance.error = e
+                conn.skip_stream()
+            finally:
+                # read what has arrived, even if the client is gone
+                utterance.chunks.put(None)
+        else:
+            try:
+                utterance.text = payload.decode('utf-8')
+            except UnicodeDecodeError as e:
+                utterance.error = e
+            self.utterances.put(utterance)
+            self._server_log(
+                f"Received from {conn.address} << {utterance.text}")
+        self._server_log(
+            f"Pending utterances: {self.utterances.qsize()}")
+
+    def handle_cancel(self, turn_id):
+        # go back to idle and stop the speech right away, while the answer
+        # winds down on the speaker thread; a pending answer of the turn is
+        # skipped when its turn comes
+        if turn_id == self.speaking_turn:
+            self._set_actor_state(Action.IDLE)
+            self.lip_sync.reset()
+        self.tts_client.cancel(turn_id)
+
+    # Reads the queued answers aloud, in the order they have arrived. Every
+    # answer gets its reply, even if it could not be read.
+    def _speaker(self):
         while True:
-            bot_answer = self.client_socket.recv(
-                self.recv_buflen).decode('utf-8')
-
-            if bot_answer:
-                self._server_log(
-                    f"Received from {self.client_ip} << {bot_answer}")
-                iter_reader = self.tts_client.read_aloud(bot_answer)
-                next(iter_reader)
-                self.actor_state = Action.SPEAKING
-                next(iter_reader)
-                self.actor_state = Action.IDLE
-
-                response = "[ACTION DONE]"
-                self.client_socket.sendall(response.strip().encode('utf-8'))
-                self._server_log(f"Send >> {response}")
+            utterance = self.utterances.get()
+            error = utterance.error
+            if error is None and not self.is_cancelled(utterance.turn_id):
+                try:
+                    self._read_aloud(utterance)
+                except Exception as e:
+                    error = e
+            conn = utterance.conn
+            try:
+                if error is None:
+                    response = "[ACTION DONE]"
+                    conn.send(MessageType.STATUS, response)
+                else:
+                    response = str(error)
+                    if not isinstance(error, ServiceError):
+                        response = f"{type(error).__name__}: {response}"
+                    self._server_log(
+                        f"Failed to react to {conn.address} ({response})")
+                    conn.send(MessageType.ERROR, response)
+            except OSError as e:
+                self._server_log(f"Failed to reply to {conn.address} ({e})")
+                continue
+            self.tracer.record('action_done', utterance.turn_id,
+                               utterance.start)
+            self._server_log(f"Send >> {response}")
+
+    def _read_aloud(self, utterance):
+        if utterance.text is None:
+            bot_answer = utterance.iter_chunks()
+        elif utterance.text:
+            bot_answer = utterance.text
+        else:
+            return
+
+        turn_id = utterance.turn_id
+        self.speaking_turn = turn_id
+        try:
+            # the TTS server records its spans for the same turn
+            if turn_id and turn_id != self.tts_client.turn_id:
+                self.tts_client.begin_turn(turn_id)
+            iter_reader = self.tts_client.read_aloud(
+                bot_answer, on_audio=self._on_tts_audio)
+            next(iter_reader)
+            if not self.is_cancelled(turn_id):
+                self._set_actor_state(Action.SPEAKING)
+            next(iter_reader)
+        finally:
+            self.speaking_turn = None
+            self._set_actor_state(Action.IDLE)
+            self.lip_sync.reset()
+        self._server_log(f"Frame stats: {self.frame_stats.summary()}")
+        self._server_log(
+            f"Receiver stats: {self.openseeface_sender.summary()}")
 
     def _init_actions(self):
         # List all action files in the directory
@@ -97,7 +479,7 @@ class ActionServer(ServerBase):
             ActionServer.OPENSEEFACE_ACTION_DIR) if os.path.isfile(
             os.path.join(ActionServer.OPENSEEFACE_ACTION_DIR, f))]
 
-        # Read actions into memory
+        # Map actions into memory
         action_frames = {}
         for file in action_files:
             # Filename should be the valid value of Enum Action
@@ -106,32 +488,104 @@ class ActionServer(ServerBase):
             else:
                 continue
 
-            frames = []
-            with open(os.path.join(
-                    ActionServer.OPENSEEFACE_ACTION_DIR, file),
-                    'rb') as fp:
-                while True:
-                    frame = fp.read(ActionServer.OPENSEEFACE_FRAME_LEN)
-                    if not frame:
-                        break  # End of file
-                    frames.append(frame)
-                action_frames[action] = frames
+            action_frames[action] = Clip(
+                os.path.join(ActionServer.OPENSEEFACE_ACTION_DIR, file),
+                ActionServer.OPENSEEFACE_FRAME_LEN)
         return action_frames
 
-    # Perform different actions based on self.actor_state
+    def _on_tts_audio(self, msg_type, payload):
+        if msg_type is MessageType.AUDIO_STREAM:
+            rate, channels = AUDIO_HEADER.unpack(payload)
+            self.lip_sync.start(rate, channels)
+        elif msg_type is MessageType.AUDIO:
+            self.lip_sync.feed(payload)
+
+    def _set_actor_state(self, state):
+        with self.actor_state_changed:
+            self.actor_state = state
+            self.actor_state_changed.notify_all()
+
+    # Perform different actions based on self.actor_state.
+    # Every frame has a deadline on the monotonic clock, so the time spent
+    # in sendto() does not add up, and frames that are too late to be sent
+    # on time are dropped to keep the action in sync with the real time.
     def _action_daemon(self):
-        delay = 1 / self.action_fps
+        period = 1 / self.action_fps
+        action = None
+        frame_index = 0
+        transition = []
+        # a copy of the frame to be sent, for patching the mouth
+        frame_buffer = bytearray(ActionServer.OPENSEEFACE_FRAME_LEN)
+        deadline = time.monotonic()
         while True:
-            for action in Action:
-                if self.actor_state is action:
-                    for frame in self.openseeface_actions[action]:
-                        if self.actor_state is not action:
-                            break
-                        self.openseeface_client_socket.sendto(
-                            frame, (self.openseeface_client_ip,
-                                    self.openseeface_client_port))
-                        time.sleep(delay)
-                    break
+            with self.actor_state_changed:
+                timeout = deadline - time.monotonic()
+                if timeout > 0 and self.actor_state is action:
+                    # wake up for the next frame or for a new state
+                    self.actor_state_changed.wait(timeout)
+                state = self.actor_state
+
+            now = time.monotonic()
+            if state is not action:
+                # start the new action right now, fading in from the old one
+                transition = self._make_transition(action, frame_index, state)
+                action = state
+                frame_index = 0
+                deadline = now
+            elif now < deadline:
+                continue
+
+            late_frames = int((now - deadline) / period)
+            if late_frames > 0:
+                frame_index += late_frames
+                deadline += late_frames * period
+                self.frame_stats.record_dropped(late_frames)
+
+            frames = self.openseeface_actions[action]
+            if frame_index < len(transition):
+                frame = transition[frame_index]
+            elif len(frames) > 0:
+                # a memoryview into the mapped clip, sent without copying
+                frame = frames[frame_index % len(frames)]
+            else:
+                frame = None
+
+            if frame is not None and action is Action.SPEAKING:
+                mouth_open = self.lip_sync.mouth_open(time.monotonic())
+                if mouth_open is not None:
+                    frame_buffer[:] = frame
+                    ActionServer.OPENSEEFACE_MOUTH_OPEN.pack_into(
+                        frame_buffer,
+                        ActionServer.OPENSEEFACE_MOUTH_OPEN_OFFSET,
+                        mouth_open)
+                    frame = frame_buffer
+
+            if frame is not None:
+                self.openseeface_sender.send(frame)
+                self.frame_stats.record_sent(time.monotonic(), deadline)
+
+            frame_index += 1
+            deadline += period
+
+    # The first frames of the new action, blended with the frames the old
+    # action would have played next
+    def _make_transition(self, old_action, old_frame_index, new_action):
+        num_frames = len(self.transition_weights)
+        if old_action is None or num_frames == 0:
+            return []
+        old_frames = self.openseeface_decoded_actions[old_action]
+        new_frames = self.openseeface_decoded_actions[new_action]
+        if len(old_frames) == 0 or len(new_frames) == 0:
+            return []
+
+        steps = np.arange(num_frames)
+        blended = interpolate(
+            old_frames[(old_frame_index + steps) % len(old_frames)],
+            new_frames[steps % len(new_frames)],
+            self.transition_weights)
+        transition = memoryview(encode(blended))
+        return [transition[i * FRAME_LEN:(i + 1) * FRAME_LEN]
+                for i in range(num_frames)]
 
 
 if __name__ == '__main__':
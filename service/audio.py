@@ -0,0 +1,153 @@
+import struct
+import numpy as np
+
+
+# Whisper models work on 16 kHz mono audio
+WHISPER_SAMPLE_RATE = 16000
+
+# An AUDIO payload starts with the sample rate (4 bytes) and the number of
+# channels (2 bytes), followed by interleaved 16-bit little-endian PCM
+AUDIO_HEADER = struct.Struct('!IH')
+
+
+def pack_pcm16(pcm, rate, channels):
+    return AUDIO_HEADER.pack(rate, channels) + pcm
+
+
+def unpack_pcm16(payload):
+    rate, channels = AUDIO_HEADER.unpack_from(payload)
+    # no copy, the samples are a view into the received payload
+    samples = np.frombuffer(payload, dtype='<i2', offset=AUDIO_HEADER.size)
+    return samples, rate, channels
+
+
+def pcm16_to_float32(samples):
+    return samples.astype(np.float32) / 32768.0
+
+
+def downmix(samples, channels):
+    if channels == 1:
+        return samples
+    # interleaved frames -> (frames, channels) -> average of the channels
+    frames = samples[:len(samples) - len(samples) % channels]
+    return frames.reshape(-1, channels).mean(axis=1, dtype=np.float32)
+
+
+def resample(samples, src_rate, dst_rate):
+    if src_rate == dst_rate or len(samples) == 0:
+        return samples
+    # linear interpolation is good enough for speech recognition
+    duration = len(samples) / src_rate
+    src_times = np.arange(len(samples)) / src_rate
+    dst_times = np.arange(int(duration * dst_rate)) / dst_rate
+    return np.interp(dst_times, src_times, samples).astype(samples.dtype)
+
+
+def convert_pcm16(pcm, src_rate, src_channels, dst_rate, dst_channels):
+    if (src_rate, src_channels) == (dst_rate, dst_channels):
+        return pcm
+    samples = np.frombuffer(pcm, dtype='<i2')
+    samples = downmix(pcm16_to_float32(samples), src_channels)
+    samples = resample(samples, src_rate, dst_rate)
+    if dst_channels > 1:
+        # interleave the mono samples into every channel
+        samples = np.repeat(samples, dst_channels)
+    samples = np.clip(samples * 32768.0, -32768, 32767)
+    return samples.astype('<i2').tobytes()
+
+
+def pcm16_to_whisper_input(payload):
+    samples, rate, channels = unpack_pcm16(payload)
+    samples = downmix(pcm16_to_float32(samples), channels)
+    return resample(samples, rate, WHISPER_SAMPLE_RATE)
+
+
+# Energy-based voice activity detection. Audio fed in while the user is
+# still talking is cut into speech windows at the pauses, so every window
+# can be transcribed as soon as it is complete.
+class SpeechSegmenter:
+    def __init__(self, rate=WHISPER_SAMPLE_RATE, frame_ms=30,
+                 threshold=0.01, min_silence_ms=500, preroll_ms=300,
+                 max_window_s=25):
+        self.frame_len = rate * frame_ms // 1000
+        self.threshold = threshold
+        self.min_silence_frames = min_silence_ms // frame_ms
+        self.preroll_frames = preroll_ms // frame_ms
+        # Whisper can not see more than 30 s at once
+        self.max_window_frames = max_window_s * 1000 // frame_ms
+
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.scanned_frames = 0
+        self.silent_frames = 0
+        self.speech_seen = False
+
+    def feed(self, samples):
+        self.buffer = np.concatenate((self.buffer, samples))
+        frame_len = self.frame_len
+        num_frames = len(self.buffer) // frame_len
+        frames = self.buffer[self.scanned_frames * frame_len:
+                             num_frames * frame_len].reshape(-1, frame_len)
+        is_loud = np.sqrt(np.mean(np.square(frames), axis=1)) \
+            > self.threshold
+
+        windows = []
+        start = 0  # the frame where the current window begins
+        for index, loud in enumerate(is_loud, start=self.scanned_frames):
+            if loud:
+                self.speech_seen = True
+                self.silent_frames = 0
+            else:
+                self.silent_frames += 1
+
+            if self.speech_seen:
+                if self.silent_frames >= self.min_silence_frames \
+                        or index + 1 - start >= self.max_window_frames:
+                    windows.append(
+                        self.buffer[start * frame_len:(index + 1) * frame_len])
+                    start = index + 1
+                    self.speech_seen = False
+                    self.silent_frames = 0
+            elif self.silent_frames > self.preroll_frames:
+                # drop the silence before the speech but a short pre-roll
+                start = index + 1 - self.preroll_frames
+
+        self.buffer = self.buffer[start * frame_len:]
+        self.scanned_frames = num_frames - start
+        return windows
+
+    def flush(self):
+        # the tail of the audio after the last complete window
+        tail = self.buffer if self.speech_seen else None
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.scanned_frames = 0
+        self.silent_frames = 0
+        self.speech_seen = False
+        return tail
+
+
+def open_input_stream(audio, rate, channels, chunk):
+    # only the front-end records, so the servers never load PortAudio
+    import pyaudio
+
+    # Whisper works on 16 kHz mono, so we try to record in this format.
+    # If the device can not do it, record in its default format and
+    # convert the audio on our side.
+    device = audio.get_default_input_device_info()
+    device_rate = int(device['defaultSampleRate'])
+    device_channels = max(1, min(2, int(device['maxInputChannels'])))
+    for capture_rate, capture_channels in [(rate, channels),
+                                           (device_rate, channels),
+                                           (device_rate, device_channels)]:
+        try:
+            audio.is_format_supported(capture_rate,
+                                      input_device=device['index'],
+                                      input_channels=capture_channels,
+                                      input_format=pyaudio.paInt16)
+        except ValueError:
+            continue
+        break
+
+    stream = audio.open(format=pyaudio.paInt16, channels=capture_channels,
+                        rate=capture_rate, input=True,
+                        frames_per_buffer=chunk)
+    return stream, capture_rate, capture_channels
@@ -1,11 +1,54 @@
-# TODO: Rewrite me using socketserver
-# https://docs.python.org/3/library/socketserver.html
-# https://stackoverflow.com/questions/12233940/passing-extra-metadata-to-a-requesthandler-using-pythons-socketserver-and-child
-
+import enum
 import time
+import queue
 import socket
+import struct
 import datetime
-from select import select
+import threading
+import socketserver
+from collections import OrderedDict
+
+from service.trace import Tracer, metrics
+
+
+class MessageType(enum.IntEnum):
+    TEXT = 1    # utf-8 encoded text
+    AUDIO = 2   # raw audio bytes
+    STATUS = 3  # utf-8 encoded status marker, e.g. '[START READING]'
+    ERROR = 4   # utf-8 encoded error description
+    STREAM = 5  # like TEXT, but asks for the reply as a stream of TOKENs
+    TOKEN = 6   # utf-8 encoded chunk of a streamed text
+    END = 7     # marks the end of a stream
+    AUDIO_STREAM = 8  # opens a stream of AUDIO chunks
+    TRACE = 9   # utf-8 encoded id of the turn the next requests belong to
+    SESSION = 10  # utf-8 encoded id of the chat session to continue
+    CANCEL = 11  # utf-8 encoded id of the turn to stop working on
+
+
+# Every message on the wire is a fixed header followed by the payload.
+# The header holds the message type (1 byte) and the payload length
+# (4 bytes, network byte order).
+MESSAGE_HEADER = struct.Struct('!BI')
+
+# Payloads larger than this are not copied into the header buffer but
+# handed to the kernel in a single separate sendall() call
+BULK_PAYLOAD_LEN = 64 * 1024
+
+# Larger payloads are refused before anything is allocated for them, e.g.
+# when a peer on another host sends garbage; a minute of 48 kHz stereo PCM
+# is about 11 MiB
+MAX_PAYLOAD_LEN = 64 * 1024 * 1024
+
+
+# Raised by a client when the server replies with an ERROR message
+class ServiceError(Exception):
+    pass
+
+
+# Raised when the peer sends something that is not a valid message. The
+# stream can not be resynchronized then, so the connection is given up.
+class ProtocolError(ConnectionError):
+    pass
 
 
 def service_log(obj, msg):
@@ -15,13 +58,55 @@ def service_log(obj, msg):
     print(f"[{time_stamp}][{class_name}@{obj_id}] {msg}")
 
 
+def send_message(sock, msg_type, payload=b''):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    header = MESSAGE_HEADER.pack(msg_type, len(payload))
+    if len(payload) > BULK_PAYLOAD_LEN:
+        sock.sendall(header)
+        sock.sendall(payload)
+    else:
+        sock.sendall(header + payload)
+
+
+def recv_exactly(sock, size, recv_buflen=4096):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    # a single recv() may return only a part of the message
+    while received < size:
+        count = sock.recv_into(view[received:],
+                               min(size - received, recv_buflen))
+        if count == 0:
+            raise ConnectionError("Connection closed by peer")
+        received += count
+    return buffer
+
+
+def recv_message(sock, recv_buflen=4096):
+    msg_type, length = MESSAGE_HEADER.unpack(
+        recv_exactly(sock, MESSAGE_HEADER.size, recv_buflen))
+    try:
+        msg_type = MessageType(msg_type)
+    except ValueError:
+        raise ProtocolError(f"Unknown message type {msg_type}") from None
+    if length > MAX_PAYLOAD_LEN:
+        raise ProtocolError(f"Payload of {length} bytes is too large")
+    payload = recv_exactly(sock, length, recv_buflen)
+    return msg_type, payload
+
+
 class ClientBase:
     def __init__(self, server_ip, server_port, recv_buflen):
         self._client_log("Initializing the client...")
         self.server_ip = server_ip
         self.server_port = server_port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # streams are many small messages, do not hold them back (Nagle)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.recv_buflen = recv_buflen
+        self.turn_id = None
+        self.tracer = Tracer(self.__class__.__name__)
 
     def __del__(self):
         if self.socket:
@@ -44,47 +129,237 @@ class ClientBase:
             count += 1
         self._client_log("Failed to connect to server")
 
+    # tag the following requests with the id of the conversation turn, so
+    # the server can record its spans for it; call it between requests
+    def begin_turn(self, turn_id):
+        self.turn_id = turn_id
+        self._send(MessageType.TRACE, turn_id)
+
+    # Ask the server to stop working on the turn, e.g. when the user starts
+    # talking again. This goes over a connection of its own, as the usual
+    # one is busy with the request being cancelled.
+    def cancel(self, turn_id=None):
+        turn_id = turn_id or self.turn_id
+        if turn_id is None:
+            return
+        with socket.create_connection((self.server_ip,
+                                       self.server_port)) as sock:
+            send_message(sock, MessageType.CANCEL, turn_id)
+
+    def _send(self, msg_type, payload=b''):
+        send_message(self.socket, msg_type, payload)
+
+    def _recv(self):
+        msg_type, payload = recv_message(self.socket, self.recv_buflen)
+        if msg_type is MessageType.ERROR:
+            raise ServiceError(payload.decode('utf-8', errors='replace'))
+        return msg_type, payload
+
+    def _send_stream(self, chunks, msg_type=MessageType.TOKEN):
+        for chunk in chunks:
+            if chunk:
+                self._send(msg_type, chunk)
+        self._send(MessageType.END)
+
     def _client_log(self, msg):
         service_log(self, msg)
 
 
+class Connection:
+    def __init__(self, sock, address, recv_buflen):
+        self.socket = sock
+        self.address = address
+        self.recv_buflen = recv_buflen
+        # set by the client with a TRACE message before its requests
+        self.turn_id = None
+        # set by the client with a SESSION message to resume a session
+        self.session_id = None
+        # replies may be sent from the worker and the handler thread
+        self.send_lock = threading.Lock()
+        # whether the request is a stream whose END has not been read yet
+        self.in_stream = False
+
+    def send(self, msg_type, payload=b''):
+        with self.send_lock:
+            send_message(self.socket, msg_type, payload)
+
+    def recv(self):
+        return recv_message(self.socket, self.recv_buflen)
+
+    def shutdown(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def iter_stream(self, first_chunk=b'', encoding='utf-8'):
+        # yield the chunks of a stream until its END arrives
+        chunk = first_chunk
+        while True:
+            if chunk:
+                yield chunk.decode(encoding) if encoding else chunk
+            msg_type, chunk = self.recv()
+            if msg_type is MessageType.END:
+                self.in_stream = False
+                break
+
+    # read the rest of a stream the request has stopped at, otherwise its
+    # chunks would be taken for the next requests
+    def skip_stream(self):
+        while self.in_stream:
+            msg_type, _ = self.recv()
+            if msg_type is MessageType.END:
+                self.in_stream = False
+
+
+# https://stackoverflow.com/questions/12233940/passing-extra-metadata-to-a-requesthandler-using-pythons-socketserver-and-child
+class _ConnectionHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.server.service._serve_connection(
+            self.request, self.client_address)
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
 class ServerBase:
-    def __init__(self, ip, port, recv_buflen):
+    # the latency percentiles are logged at most this often (seconds)
+    METRICS_LOG_INTERVAL = 60
+
+    def __init__(self, ip, port, recv_buflen,
+                 max_pending_requests=8, num_request_workers=1):
         self._server_log("Initializing the server...")
         self.port = port
         self.server_ip = ip
-        self.server_socket = None
-        self.client_ip = None
-        self.client_socket = None
+        self.tcp_server = None
+        self.listen_timeout = None
         self.recv_buflen = recv_buflen
+        # every connection has its own handler thread, while the (expensive)
+        # model behind the server is driven by a few worker threads only
+        self.requests = queue.Queue(maxsize=max_pending_requests)
+        self.num_request_workers = num_request_workers
+        self.request_worker_threads = []
+        self.tracer = Tracer(self.__class__.__name__)
+        # the recently cancelled turns, see is_cancelled()
+        self.cancelled_turns = OrderedDict()
+        self.cancelled_turns_lock = threading.Lock()
+        self.metrics_logged_at = time.monotonic()
+        self.metrics_log_lock = threading.Lock()
 
     def __del__(self):
-        if self.server_socket:
-            self.server_socket.close()
-        if self.client_socket:
-            self.client_socket.close()
+        if self.tcp_server:
+            self.tcp_server.server_close()
 
     def connect(self, listen_timeout=1):
-        self.server_socket = socket.socket(
-            socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(
-            socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-        self.server_socket.bind((self.server_ip, self.port))
-
+        self.listen_timeout = listen_timeout
+        self.tcp_server = _ThreadingTCPServer(
+            (self.server_ip, self.port), _ConnectionHandler)
+        self.tcp_server.service = self
         self._server_log(f"Listening on {self.server_ip}:{self.port}")
-        while True:
-            self.server_socket.listen()
-            # Accept incoming connections
-            ready, _, _ = select([self.server_socket], [], [], listen_timeout)
-            if ready:
-                self.client_socket, self.client_ip = \
-                    self.server_socket.accept()
-                break
-        self._server_log(f"Connected to {self.client_ip}")
 
     def run(self):
+        for _ in range(self.num_request_workers):
+            worker_thread = threading.Thread(target=self._request_worker)
+            worker_thread.daemon = True
+            worker_thread.start()
+            self.request_worker_threads.append(worker_thread)
+
+        self.tcp_server.serve_forever(poll_interval=self.listen_timeout)
+
+    def handle_request(self, conn, msg_type, payload):
+        pass
+
+    def handle_disconnect(self, conn):
         pass
 
+    # called on the connection thread as soon as a turn is cancelled, while
+    # the request of the turn may still be running on a worker
+    def handle_cancel(self, turn_id):
+        pass
+
+    # the workers check this between tokens or sentences and stop early
+    def is_cancelled(self, turn_id):
+        with self.cancelled_turns_lock:
+            return turn_id is not None and turn_id in self.cancelled_turns
+
+    def _cancel_turn(self, turn_id):
+        with self.cancelled_turns_lock:
+            self.cancelled_turns[turn_id] = True
+            # only the recent turns may still be running
+            while len(self.cancelled_turns) > 256:
+                self.cancelled_turns.popitem(last=False)
+        self._server_log(f"Cancelled turn {turn_id}")
+        self.handle_cancel(turn_id)
+
+    def _serve_connection(self, sock, address):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(sock, address, self.recv_buflen)
+        self._server_log(f"Connected to {address}")
+        try:
+            while True:
+                msg_type, payload = conn.recv()
+                if msg_type is MessageType.TRACE:
+                    conn.turn_id = payload.decode('utf-8', errors='replace')
+                    continue
+                if msg_type is MessageType.SESSION:
+                    conn.session_id = payload.decode('utf-8',
+                                                     errors='replace')
+                    continue
+                if msg_type is MessageType.CANCEL:
+                    self._cancel_turn(payload.decode('utf-8',
+                                                     errors='replace'))
+                    continue
+                # block here if the model is busy with too many requests
+                done = threading.Event()
+                self.requests.put((conn, msg_type, payload, done))
+                done.wait()
+        except OSError as e:
+            self._server_log(f"Disconnected from {address} ({e})")
+        self.handle_disconnect(conn)
+
+    def _request_worker(self):
+        while True:
+            conn, msg_type, payload, done = self.requests.get()
+            conn.in_stream = msg_type in (MessageType.TOKEN,
+                                          MessageType.AUDIO_STREAM)
+            try:
+                self.handle_request(conn, msg_type, payload)
+            except Exception as e:
+                # keep the worker alive and let the client fail, instead of
+                # leaving it waiting for a reply; even an OSError may come
+                # from the model rather than from the connection
+                error = f"{type(e).__name__}: {e}"
+                self._server_log(
+                    f"Failed to handle the request of {conn.address} "
+                    f"({error})")
+                try:
+                    if isinstance(e, ProtocolError):
+                        # the rest of the request can not be found anymore
+                        raise e
+                    conn.skip_stream()
+                    conn.send(MessageType.ERROR, error)
+                except OSError:
+                    # give up the connection, its handler thread then sees
+                    # it closed
+                    conn.shutdown()
+            finally:
+                done.set()
+            self.log_metrics()
+
+    # log the latency percentiles of this process, unless they have been
+    # logged less than METRICS_LOG_INTERVAL seconds ago
+    def log_metrics(self, force=False):
+        now = time.monotonic()
+        with self.metrics_log_lock:
+            if not force and \
+                    now - self.metrics_logged_at < self.METRICS_LOG_INTERVAL:
+                return
+            self.metrics_logged_at = now
+        latency = metrics.summary()
+        if latency:
+            self._server_log(f"Latency: {latency}")
+
     def _server_log(self, msg):
         service_log(self, msg)
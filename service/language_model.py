@@ -1,6 +1,13 @@
 import os
-from gpt4all import GPT4All
-from service.base import ServerBase, ClientBase
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from service.base import ServerBase, ClientBase, MessageType, ServiceError
+from service.replica import LocalReplica, ProcessReplica, ReplicaPool
+from service.replica import load_model, split_cores
 
 
 class LanguageModelClient(ClientBase):
@@ -11,42 +18,472 @@ class LanguageModelClient(ClientBase):
                          recv_buflen=recv_buflen)
 
     def get_answer(self, prompt):
-        self.socket.sendall(prompt.encode('utf-8'))
-        answer = self.socket.recv(self.recv_buflen).decode('utf-8')
-        return answer
+        self._send(MessageType.TEXT, prompt)
+        _, answer = self._recv()
+        return answer.decode('utf-8')
+
+    # continue the chat session with this id, which the server keeps even
+    # after the connection is closed; call it between requests
+    def use_session(self, session_id):
+        self._send(MessageType.SESSION, session_id)
+
+    def stream_answer(self, prompt):
+        self._send(MessageType.STREAM, prompt)
+        msg_type = None
+        try:
+            while True:
+                msg_type, token = self._recv()
+                if msg_type is MessageType.END:
+                    break
+                yield token.decode('utf-8')
+        except ServiceError:
+            # the error takes the place of END
+            msg_type = MessageType.END
+            raise
+        finally:
+            # drain the rest of the stream if the caller stops early,
+            # otherwise the next reply would start with stale tokens
+            while msg_type is not MessageType.END:
+                msg_type, _ = self._recv()
+
+
+# Answers of the model stored under the hash of (model, prompt, context).
+# The model generates with temp=0, so the same prompt in the same chat
+# context always gets the same answer. The entries are dropped when they
+# are older than ttl seconds, or least recently used when the cache is full.
+# With a cache file, the entries survive a restart of the server.
+class ResponseCache:
+    def __init__(self, cache_file=None, max_items=256, ttl=None):
+        self.cache_file = cache_file
+        self.max_items = max_items
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (time stored, tokens)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if cache_file:
+            os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+        if cache_file and os.path.isfile(cache_file):
+            try:
+                with open(cache_file, 'r', encoding='utf-8') as fp:
+                    entries = json.load(fp)
+            except (OSError, ValueError):
+                entries = []
+            # the file is in LRU order, the most recently used entry last
+            for key, stored, tokens in entries:
+                self.entries[key] = (stored, tokens)
+            self._evict()
+
+    @staticmethod
+    def normalize(prompt):
+        # "What are your opening hours?" == "what are your  opening hours"
+        prompt = ' '.join(prompt.lower().split())
+        return re.sub(r'[\s.!?]+$', '', prompt)
+
+    @staticmethod
+    def key(model_name, prompt, context):
+        key_data = json.dumps(
+            [model_name, ResponseCache.normalize(prompt), context])
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            self._evict()
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][1]
+            self.misses += 1
+            return None
+
+    def put(self, key, tokens):
+        with self.lock:
+            self.entries[key] = (time.time(), list(tokens))
+            self.entries.move_to_end(key)
+            self._evict()
+            self._save()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'items': len(self.entries),
+            }
+
+    def _evict(self):
+        if self.ttl is not None:
+            expired = time.time() - self.ttl
+            for key in [k for k, (stored, _) in self.entries.items()
+                        if stored < expired]:
+                del self.entries[key]
+        while len(self.entries) > self.max_items:
+            self.entries.popitem(last=False)
+
+    def _save(self):
+        if not self.cache_file:
+            return
+        entries = [[key, stored, tokens]
+                   for key, (stored, tokens) in self.entries.items()]
+        with open(self.cache_file + '.tmp', 'w', encoding='utf-8') as fp:
+            json.dump(entries, fp)
+        os.replace(self.cache_file + '.tmp', self.cache_file)
+
+
+# A rough token count, about 4 characters per token for English text
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+# The conversation of one client: the history of the recent exchanges, and
+# a summary of the older ones once they no longer fit into the context
+class ChatSession:
+    def __init__(self, session_id, system_prompt, persistent=False):
+        self.session_id = session_id
+        self.system_prompt = system_prompt
+        # only sessions with an id given by the client can be resumed
+        self.persistent = persistent
+        self.summary = ''
+        self.history = []  # user and assistant messages, in turns
+        self.last_used = time.monotonic()
+        # the replica that generated the last turn, see ReplicaPool
+        self.replica = None
+
+    def context(self):
+        return [self.system_prompt, self.summary, self.history]
+
+    def tokens(self):
+        return estimate_tokens(self.system_prompt) \
+            + estimate_tokens(self.summary) \
+            + sum(estimate_tokens(m['content']) for m in self.history)
+
+    def add_exchange(self, prompt, answer):
+        self.history.append({'role': 'user', 'content': prompt})
+        self.history.append({'role': 'assistant', 'content': answer})
+
+    def to_dict(self):
+        return {'session_id': self.session_id,
+                'system_prompt': self.system_prompt,
+                'summary': self.summary,
+                'history': self.history}
+
+    @classmethod
+    def from_dict(cls, data):
+        session = cls(data['session_id'], data['system_prompt'],
+                      persistent=True)
+        session.summary = data['summary']
+        session.history = data['history']
+        return session
+
+
+# Keeps the recently used sessions in memory. The least recently used ones
+# and the idle ones are evicted; persistent sessions are written to
+# session_dir then, and restored from there when the client comes back.
+# A session without an id given by the client could not be restored, so it
+# is kept until its connection is closed.
+class SessionStore:
+    def __init__(self, session_dir=None, max_sessions=16, idle_timeout=600):
+        self.session_dir = session_dir
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()  # session id -> ChatSession
+        self.evicted = 0
+        self.restored = 0
+        self.lock = threading.Lock()
+        if session_dir:
+            os.makedirs(session_dir, exist_ok=True)
+
+    def get(self, session_id, system_prompt, persistent):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self._restore(session_id) if persistent else None
+                if session is None:
+                    session = ChatSession(session_id, system_prompt,
+                                          persistent)
+                self.sessions[session_id] = session
+            self.sessions.move_to_end(session_id)
+            session.last_used = time.monotonic()
+
+            excess = max(0, len(self.sessions) - self.max_sessions)
+            evictable = [i for i, s in self.sessions.items()
+                         if s.persistent and s is not session]
+            for session_id in evictable[:excess]:
+                self._evict(session_id)
+            return session
+
+    def evict_idle(self):
+        with self.lock:
+            idle_since = time.monotonic() - self.idle_timeout
+            for session_id in [i for i, s in self.sessions.items()
+                               if s.persistent
+                               and s.last_used < idle_since]:
+                self._evict(session_id)
+
+    def drop(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'sessions': len(self.sessions),
+                'evicted': self.evicted,
+                'restored': self.restored,
+            }
+
+    def _path(self, session_id):
+        name = hashlib.sha256(session_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.session_dir, name + '.json')
+
+    def _evict(self, session_id):
+        session = self.sessions.pop(session_id)
+        self.evicted += 1
+        if not (session.persistent and self.session_dir):
+            return
+        path = self._path(session_id)
+        with open(path + '.tmp', 'w', encoding='utf-8') as fp:
+            json.dump(session.to_dict(), fp)
+        os.replace(path + '.tmp', path)
+
+    def _restore(self, session_id):
+        if not self.session_dir:
+            return None
+        try:
+            with open(self._path(session_id), 'r', encoding='utf-8') as fp:
+                session = ChatSession.from_dict(json.load(fp))
+        except (OSError, ValueError, KeyError):
+            return None
+        self.restored += 1
+        return session
 
 
 class LanguageModelServer(ServerBase):
     def __init__(self, model_dir,
                  model_name="orca-mini-3b.ggmlv3.q4_0.bin", infer_device='cpu',
+                 model=None, cache=False, cache_file=None,
+                 cache_max_items=256, cache_ttl=None,
+                 context_tokens=1536, max_answer_tokens=200,
+                 truncation='window', session_dir=None, max_sessions=16,
+                 session_idle_timeout=600, num_replicas=1,
+                 threads_per_replica=None, pin_cores=True, affinity_slack=0,
                  ip='127.0.0.1', port=12345, recv_buflen=4096):
 
-        super().__init__(ip=ip, port=port, recv_buflen=recv_buflen)
+        # one request worker per replica, so they all generate at once
+        super().__init__(ip=ip, port=port, recv_buflen=recv_buflen,
+                         num_request_workers=num_replicas)
+        self.model_name = model_name
+        # the history of a session is cut to fit the context window of the
+        # model, either by dropping the oldest turns ('window') or by
+        # summarizing them ('summary')
+        self.context_tokens = context_tokens
+        self.max_answer_tokens = max_answer_tokens
+        self.truncation = truncation
+        self.sessions = SessionStore(session_dir, max_sessions,
+                                     session_idle_timeout)
+        self.cache = None
+        if cache:
+            self.cache = ResponseCache(cache_file, cache_max_items, cache_ttl)
+        self.pool = None
 
         self._server_log(
             f"Loading Language model {model_name} using {infer_device}")
+        # a stand-in for the GPT4All model can be passed for testing
+        if model is not None:
+            replicas = [LocalReplica(model)]
+        elif num_replicas <= 1:
+            replicas = [LocalReplica(load_model(
+                model_name, model_dir, infer_device, threads_per_replica))]
+        else:
+            # every replica is a process of its own, on its own cores
+            cores = split_cores(num_replicas)
+            replicas = [ProcessReplica(
+                f"replica-{i}", model_name, model_dir, infer_device,
+                threads_per_replica or len(cores[i]),
+                cores[i] if pin_cores else None)
+                for i in range(num_replicas)]
+        self.pool = ReplicaPool(replicas, affinity_slack)
+        self.pool.start()
+        self.system_prompt = self.pool.system_prompt
+
+    def __del__(self):
+        super().__del__()
+        if self.pool:
+            self.pool.stop()
+
+    def handle_request(self, conn, msg_type, payload):
+        start = time.perf_counter()
+        recv_data = payload.decode('utf-8').strip()
+        self._server_log(f"Received from {conn.address} << {recv_data}")
+
+        self.sessions.evict_idle()
+        session = self.sessions.get(self._session_id(conn),
+                                    self.system_prompt,
+                                    persistent=conn.session_id is not None)
+
+        if msg_type is MessageType.STREAM:
+            response = self._stream_answer(conn, session, recv_data, start)
+        else:
+            response = ''.join(
+                self._generate(session, recv_data, conn.turn_id)).strip()
+            conn.send(MessageType.TEXT, response)
+        self.tracer.record('generation', conn.turn_id, start)
+        self._server_log(f"Send >> {response}")
+
+        self._server_log(f"Sessions: {self.sessions.stats()}")
+        # the requests waiting for a request worker are queued, too
+        replicas = self.pool.stats()
+        replicas['queue_depth'] += self.requests.qsize()
+        self._server_log(f"Replicas: {replicas}")
+        if self.cache:
+            self._server_log(f"Response cache: {self.cache.stats()}")
 
-        os.makedirs(model_dir, exist_ok=True)
+    def handle_disconnect(self, conn):
+        # nobody can come back to a session without an id
+        if conn.session_id is None:
+            self.sessions.drop(self._session_id(conn))
+
+    def _session_id(self, conn):
+        if conn.session_id is not None:
+            return conn.session_id
+        return f"{conn.address[0]}:{conn.address[1]}"
+
+    # the tokens of the answer, either generated or replayed from the cache
+    def _generate(self, session, prompt, turn_id=None):
+        # e.g. a queued prompt the user has cancelled, the answer would not
+        # be read anyway
+        if self.is_cancelled(turn_id):
+            self._server_log(f"Skipped generating for turn {turn_id}")
+            return
+
+        key = None
+        if self.cache:
+            key = ResponseCache.key(self.model_name, prompt,
+                                    session.context())
+            tokens = self.cache.get(key)
+            if tokens is not None:
+                # the model has not seen this turn, so it has to be replayed
+                # the next time the session is generated for
+                session.add_exchange(prompt, ''.join(tokens))
+                if session.replica is not None \
+                        and session.replica.active_session is session:
+                    session.replica.active_session = None
+                yield from tokens
+                return
+
+        wait_start = time.perf_counter()
+        replica = self.pool.acquire(session.replica)
+        self.tracer.record('replica_wait', turn_id, wait_start)
+        stream = None
         try:
-            # try to check if the model has been downloaded
-            self.model = GPT4All(model_name, model_path=model_dir,
-                                 device=infer_device, allow_download=False)
-        except ValueError:
-            self.model = GPT4All(model_name, model_path=model_dir,
-                                 device=infer_device, allow_download=True)
-
-    def run(self):
-        with self.model.chat_session():
-            # Communication loop
-            while True:
-                recv_data = self.client_socket.recv(
-                    self.recv_buflen).decode('utf-8').strip()
-                self._server_log(
-                    f"Received from {self.client_ip} << {recv_data}")
-
-                response = self.model.generate(prompt=recv_data, temp=0)
-                self.client_socket.sendall(response.strip().encode('utf-8'))
-                self._server_log(f"Send >> {response}")
+            # the turn may be cancelled while it waits for the replica
+            if self.is_cancelled(turn_id):
+                self._server_log(f"Skipped generating for turn {turn_id}")
+                return
+            messages = self._load_context(replica, session, prompt)
+            # the model holds a broken conversation if the generation stops
+            replica.active_session = None
+            tokens = []
+            stream = replica.generate(
+                messages, prompt, self.max_answer_tokens,
+                cancelled=lambda: self.is_cancelled(turn_id))
+            for token in stream:
+                tokens.append(token)
+                yield token
+                if self.is_cancelled(turn_id):
+                    break
+            if self.is_cancelled(turn_id):
+                # nobody heard the answer, so it is not part of the chat
+                self._server_log(f"Stopped generating for turn {turn_id}")
+                return
+            session.add_exchange(prompt, ''.join(tokens))
+            replica.active_session = session
+            session.replica = replica
+        finally:
+            # also when the client is gone: the replica stops and finishes
+            # the answer before the next request may run on it
+            if stream is not None:
+                stream.close()
+            self.pool.release(replica)
+
+        # only complete answers are cached
+        if key:
+            self.cache.put(key, tokens)
+
+    # The chat session of GPT4All for the prompt. If the replica still holds
+    # the conversation of this session, only the new prompt has to be
+    # processed. Otherwise the model starts over, with the whole history
+    # in the system prompt.
+    def _load_context(self, replica, session, prompt):
+        if self._truncate(replica, session, prompt) \
+                and replica.active_session is session:
+            replica.active_session = None
+
+        system = {'role': 'system', 'content': session.system_prompt}
+        if replica.active_session is session:
+            return [system] + session.history
+
+        parts = [session.system_prompt]
+        if session.summary:
+            parts.append(
+                f"Summary of the conversation so far: {session.summary}")
+        if session.history:
+            parts.append(self._render(session.history))
+        header = '\n\n'.join(part for part in parts if part)
+        # a system message only, so GPT4All resets the context of the model
+        return [{'role': 'system', 'content': header}]
+
+    # Drop the oldest turns until the session, the prompt and the answer fit
+    # into the context, and tell whether anything was dropped
+    def _truncate(self, replica, session, prompt):
+        budget = self.context_tokens - self.max_answer_tokens \
+            - estimate_tokens(prompt)
+        dropped = []
+        while session.history and session.tokens() > budget:
+            dropped += session.history[:2]
+            del session.history[:2]
+        if dropped and self.truncation == 'summary':
+            session.summary = self._summarize(replica, session.summary,
+                                              dropped)
+        return bool(dropped)
+
+    def _summarize(self, replica, summary, messages):
+        text = self._render(messages)
+        if summary:
+            text = f"{summary}\n\n{text}"
+        # the summary is generated from a context of its own
+        replica.active_session = None
+        summary = replica.generate(
+            [{'role': 'system', 'content': ''}],
+            "Summarize the following conversation in a few "
+            f"sentences:\n\n{text}",
+            self.max_answer_tokens, streaming=False)
+        return summary.strip()
+
+    # the messages formatted like GPT4All formats a chat session
+    def _render(self, messages):
+        template = self.pool.prompt_template
+        return ''.join(template.format(m['content']) if m['role'] == 'user'
+                       else m['content'] + '\n' for m in messages)
+
+    def _stream_answer(self, conn, session, prompt, start):
+        tokens = []
+        for token in self._generate(session, prompt, conn.turn_id):
+            # skip the leading whitespaces like strip() does
+            if not tokens:
+                token = token.lstrip()
+                if not token:
+                    continue
+                self.tracer.record('first_token', conn.turn_id, start)
+            conn.send(MessageType.TOKEN, token)
+            tokens.append(token)
+        # if the generation fails, the request worker ends the stream with
+        # an ERROR in place of END
+        conn.send(MessageType.END)
+        return ''.join(tokens)
 
 
 if __name__ == '__main__':
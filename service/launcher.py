@@ -0,0 +1,122 @@
+import sys
+import time
+from typing import Optional
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
+
+from termcolor import colored
+
+from service import trace
+from service.base import ServerBase
+from service.action import ActionServer
+from service.language_model import LanguageModelServer
+from service.speech2text import Speech2TextServer
+from service.text2speech import EdgettsServer, Pyttsx3Server
+
+
+def run_server(ServerClass: ServerBase,
+               log_redirect_to: Optional[str],
+               trace_file: Optional[str],
+               ready_conn,
+               **kwargs):
+    if log_redirect_to == "stdout":
+        sys.stdout = sys.__stdout__
+    elif log_redirect_to is None:
+        sys.stdout = None
+    else:
+        sys.stdout = sys.__stdout__
+    trace.configure(trace_file)
+
+    load_start = time.monotonic()
+    server = ServerClass(**kwargs)
+    server.connect()
+
+    # tell the front-end that the model is loaded and we are listening
+    ready_conn.send(time.monotonic() - load_start)
+    ready_conn.close()
+    server.run()
+
+
+def start_server_process(ServerClass: ServerBase,
+                         log_redirect_to,
+                         trace_file=None,
+                         **kwargs):
+    ready_conn, child_ready_conn = Pipe(duplex=False)
+    proc_server = Process(
+        target=run_server,
+        args=[ServerClass, log_redirect_to, trace_file, child_ready_conn],
+        kwargs=kwargs
+    )
+    proc_server.daemon = True
+    proc_server.start()
+    # only the server holds the sending end, so we see EOF if it dies
+    child_ready_conn.close()
+    return proc_server, ready_conn
+
+
+def wait_for_services(services, clients):
+    # all the servers load their models in parallel, and every client
+    # connects as soon as its own server is ready
+    waiting = {ready_conn: name for name, (_, ready_conn) in services.items()}
+    wait_start = time.monotonic()
+    while waiting:
+        for ready_conn in wait(list(waiting)):
+            name = waiting.pop(ready_conn)
+            try:
+                load_time = ready_conn.recv()
+            except EOFError:
+                print(colored(f"{name} failed to start", 'red'))
+                sys.exit(1)
+            print(colored(f"{name} is ready ({load_time:.2f}s)", 'green'))
+            if name in clients:
+                clients[name].connect()
+    print(colored(f"All services are ready "
+                  f"({time.monotonic() - wait_start:.2f}s)", 'green'))
+
+
+def needs_speech2text(app_cfg):
+    # typing in the CLI never records, so the Whisper model is not loaded
+    return app_cfg.tui or app_cfg.user_input == "voice"
+
+
+def start_services(app_cfg):
+    log_redirect_to = \
+        None if app_cfg.noecho_server_log else "stdout"
+    trace_file = app_cfg.trace_file
+
+    services = {}
+    services['action'] = start_server_process(
+        ActionServer, log_redirect_to, trace_file,
+        openseeface_targets=app_cfg.openseeface_targets
+    )
+
+    services['language_model'] = start_server_process(
+        LanguageModelServer, log_redirect_to, trace_file,
+        model_dir=app_cfg.lm_model_dir,
+        cache=app_cfg.lm_cache,
+        cache_file=app_cfg.lm_cache_file,
+        cache_ttl=app_cfg.lm_cache_ttl,
+        context_tokens=app_cfg.lm_context_tokens,
+        truncation=app_cfg.lm_truncation,
+        session_dir=app_cfg.lm_session_dir,
+        num_replicas=app_cfg.lm_replicas,
+        threads_per_replica=app_cfg.lm_threads_per_replica
+    )
+
+    if needs_speech2text(app_cfg):
+        services['speech2text'] = start_server_process(
+            Speech2TextServer, log_redirect_to, trace_file,
+            model_dir=app_cfg.stt_model_dir
+        )
+
+    if app_cfg.tts_engine == "pyttsx3":
+        TtsServerClass = Pyttsx3Server
+    elif app_cfg.tts_engine == "edge-tts":
+        TtsServerClass = EdgettsServer
+    else:
+        TtsServerClass = EdgettsServer
+    services['text2speech'] = start_server_process(
+        TtsServerClass, log_redirect_to, trace_file,
+        cache_dir=app_cfg.tts_cache_dir
+    )
+    return services
@@ -0,0 +1,145 @@
+import os
+import mmap
+import numpy as np
+
+
+# Every OpenSeeFace packet describes one tracked face in one frame
+FRAME_LEN = 1785
+
+# https://github.com/emilianavt/OpenSeeFace/blob/master/facetracker.py
+FEATURE_NAMES = (
+    'eye_l', 'eye_r',
+    'eyebrow_steepness_l', 'eyebrow_updown_l', 'eyebrow_quirk_l',
+    'eyebrow_steepness_r', 'eyebrow_updown_r', 'eyebrow_quirk_r',
+    'mouth_corner_updown_l', 'mouth_corner_inout_l',
+    'mouth_corner_updown_r', 'mouth_corner_inout_r',
+    'mouth_open', 'mouth_wide',
+)
+
+# The packet layout as a packed little-endian NumPy structured dtype
+PACKET_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('face_id', '<i4'),
+    ('width', '<f4'),
+    ('height', '<f4'),
+    ('eye_blink_r', '<f4'),
+    ('eye_blink_l', '<f4'),
+    ('success', 'u1'),
+    ('pnp_error', '<f4'),
+    ('quaternion', '<f4', (4,)),
+    ('euler', '<f4', (3,)),
+    ('translation', '<f4', (3,)),
+    ('landmark_confidence', '<f4', (68,)),
+    ('landmarks', '<f4', (68, 2)),  # (y, x) in image coordinates
+    ('points_3d', '<f4', (70, 3)),
+    ('features', '<f4', (len(FEATURE_NAMES),)),
+])
+assert PACKET_DTYPE.itemsize == FRAME_LEN
+
+
+def feature_index(name):
+    return FEATURE_NAMES.index(name)
+
+
+def feature_offset(name):
+    # byte offset of a feature inside a packet, for patching raw frames
+    features_offset = PACKET_DTYPE.fields['features'][1]
+    return features_offset + feature_index(name) * 4
+
+
+def decode(buffer):
+    # all the frames in the buffer at once, as a view without copying
+    usable_len = len(buffer) - len(buffer) % FRAME_LEN
+    return np.frombuffer(buffer, dtype=PACKET_DTYPE,
+                         count=usable_len // FRAME_LEN)
+
+
+def encode(frames):
+    return np.ascontiguousarray(frames, dtype=PACKET_DTYPE).tobytes()
+
+
+def interpolate(frames_a, frames_b, weights):
+    # (1 - w) * a + w * b for every float field of the frames, the
+    # integer fields are taken from the nearer frame
+    weights = np.asarray(weights, dtype=np.float32)
+    frames = np.empty(np.broadcast(frames_a, frames_b, weights).shape,
+                      dtype=PACKET_DTYPE)
+    for name in PACKET_DTYPE.names:
+        a, b = frames_a[name], frames_b[name]
+        w = weights.reshape(weights.shape + (1,) * (a.ndim - weights.ndim))
+        if PACKET_DTYPE[name].base.kind == 'f':
+            frames[name] = a + (b - a) * w
+        else:
+            frames[name] = np.where(w < 0.5, a, b)
+
+    # keep the rotations valid
+    norms = np.linalg.norm(frames['quaternion'], axis=-1, keepdims=True)
+    frames['quaternion'] /= np.where(norms > 0, norms, 1)
+    return frames
+
+
+def retime(frames, src_fps, dst_fps, loop=True):
+    # play the frames at another speed, e.g. a 24 fps clip at 60 fps
+    num_frames = len(frames)
+    num_out = int(round(num_frames * dst_fps / src_fps))
+    positions = np.arange(num_out) * (src_fps / dst_fps)
+    index_a = np.floor(positions).astype(np.int64)
+    index_b = index_a + 1
+    if loop:
+        index_a %= num_frames
+        index_b %= num_frames
+    else:
+        index_a = np.minimum(index_a, num_frames - 1)
+        index_b = np.minimum(index_b, num_frames - 1)
+
+    retimed = interpolate(frames[index_a], frames[index_b],
+                          positions - np.floor(positions))
+    retimed['timestamp'] = frames['timestamp'][0] + np.arange(num_out) / dst_fps
+    return retimed
+
+
+# A recorded action clip, i.e. a file of OpenSeeFace packets back to back.
+# The file is memory-mapped instead of being read, so opening a clip takes
+# the same time whatever its size, and every frame is a memoryview of the
+# mapping that can be sent without being copied.
+class Clip:
+    def __init__(self, path, frame_len=FRAME_LEN):
+        self.path = path
+        self.frame_len = frame_len
+        self.mmap = None
+        self.view = memoryview(b'')
+
+        with open(path, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            # an empty file can not be mapped
+            if size > 0:
+                self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.mmap)
+
+        # the offset of every frame, for seeking to any position of the clip
+        self.offsets = range(0, size - size % frame_len, frame_len)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        offset = self.offsets[index]
+        return self.view[offset:offset + self.frame_len]
+
+    def __iter__(self):
+        for offset in self.offsets:
+            yield self.view[offset:offset + self.frame_len]
+
+    def decode(self):
+        # the whole clip as one structured array, still backed by the mapping
+        return decode(self.view)
+
+    def frame_index_at(self, seconds, fps):
+        # the clip loops, so any time maps to one of its frames
+        return int(seconds * fps) % len(self) if len(self) else 0
+
+    def close(self):
+        self.view.release()
+        if self.mmap:
+            self.mmap.close()
+            self.mmap = None
@@ -0,0 +1,313 @@
+import os
+import sys
+import json
+import queue
+import threading
+import subprocess
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def load_model(model_name, model_dir, infer_device='cpu', n_threads=None):
+    # imported here so that the clients and the front-end do not pay for
+    # the model runtime when they only need the message protocol
+    from gpt4all import GPT4All
+
+    os.makedirs(model_dir, exist_ok=True)
+    try:
+        # try to check if the model has been downloaded
+        return GPT4All(model_name, model_path=model_dir, device=infer_device,
+                       n_threads=n_threads, allow_download=False)
+    except ValueError:
+        return GPT4All(model_name, model_path=model_dir, device=infer_device,
+                       n_threads=n_threads, allow_download=True)
+
+
+# Splits the cores this process may run on into one set per replica
+def split_cores(num_replicas):
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    size = max(1, len(cores) // num_replicas)
+    return [cores[(i * size) % len(cores):(i * size) % len(cores) + size]
+            for i in range(num_replicas)]
+
+
+# One copy of the model, which generates one answer at a time
+class Replica(ABC):
+    def __init__(self, name):
+        self.name = name
+        # requests running on or waiting for this replica, see ReplicaPool
+        self.load = 0
+        self.busy = threading.Lock()
+        # the chat session whose conversation the model currently holds
+        self.active_session = None
+        self.system_prompt = ''
+        self.prompt_template = '{0}'
+
+    def start(self):
+        pass
+
+    def wait_ready(self):
+        pass
+
+    def stop(self):
+        pass
+
+    # messages become the chat session of GPT4All before the prompt is
+    # added; the generation stops at the next token once cancelled() is true
+    @abstractmethod
+    def generate(self, messages, prompt, max_tokens, streaming=True,
+                 cancelled=None):
+        pass
+
+
+# The model loaded in this process
+class LocalReplica(Replica):
+    def __init__(self, model, name='local'):
+        super().__init__(name)
+        self.model = model
+        self.chat_session = None
+
+    def start(self):
+        # the chat session of GPT4All provides the prompt template and the
+        # system prompt, the history is kept by the server
+        self.chat_session = self.model.chat_session()
+        self.chat_session.__enter__()
+        session = getattr(self.model, 'current_chat_session', None)
+        if session:
+            self.system_prompt = session[0]['content']
+        config = getattr(self.model, 'config', {})
+        self.prompt_template = config.get('promptTemplate', '{0}')
+
+    def stop(self):
+        if self.chat_session:
+            self.chat_session.__exit__(None, None, None)
+            self.chat_session = None
+
+    def generate(self, messages, prompt, max_tokens, streaming=True,
+                 cancelled=None):
+        self.model.current_chat_session = messages
+        # set once the caller stops reading the tokens
+        stopped = threading.Event()
+
+        # GPT4All stops generating when the callback returns False
+        def callback(token_id, response):
+            if stopped.is_set():
+                return False
+            return cancelled is None or not cancelled()
+        tokens = self.model.generate(prompt=prompt, temp=0,
+                                     max_tokens=max_tokens,
+                                     streaming=streaming, callback=callback)
+        return self._tokens(tokens, stopped) if streaming else tokens
+
+    # GPT4All generates on a thread of its own. When the caller stops early,
+    # the generation is stopped and waited for, so the next request does
+    # not run on the model at the same time.
+    def _tokens(self, tokens, stopped):
+        try:
+            for token in tokens:
+                yield token
+        finally:
+            stopped.set()
+            for _ in tokens:
+                pass
+
+
+# The model loaded in a child process, pinned to its own cores. Requests and
+# tokens are exchanged as JSON lines over the stdin and stdout of the child.
+# The servers run as daemonic processes, which may not start children with
+# multiprocessing, so the child is a plain subprocess.
+class ProcessReplica(Replica):
+    def __init__(self, name, model_name, model_dir, infer_device='cpu',
+                 n_threads=None, cores=None):
+        super().__init__(name)
+        self.config = {
+            'model_name': model_name,
+            'model_dir': model_dir,
+            'infer_device': infer_device,
+            'n_threads': n_threads,
+            'cores': cores,
+        }
+        self.proc = None
+        self.request_id = 0
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, '-m', 'service.replica',
+             json.dumps(self.config)],
+            cwd=REPO_ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            text=True, encoding='utf-8', bufsize=1)
+
+    def wait_ready(self):
+        ready = self._recv()
+        if ready is None:
+            raise RuntimeError(f"Replica {self.name} failed to start")
+        self.system_prompt = ready['system_prompt']
+        self.prompt_template = ready['prompt_template']
+
+    def stop(self):
+        if self.proc:
+            # the child exits when its stdin is closed
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+
+    def generate(self, messages, prompt, max_tokens, streaming=True,
+                 cancelled=None):
+        self.request_id += 1
+        self._send(id=self.request_id, messages=messages, prompt=prompt,
+                   max_tokens=max_tokens)
+        tokens = self._tokens(cancelled)
+        return tokens if streaming else ''.join(tokens)
+
+    def _tokens(self, cancelled):
+        reply = None
+        try:
+            while True:
+                reply = self._recv()
+                if reply is None:
+                    raise RuntimeError(f"Replica {self.name} has exited")
+                if 'error' in reply:
+                    raise RuntimeError(reply['error'])
+                if reply.get('end'):
+                    break
+                if cancelled is not None and cancelled():
+                    # the child stops at its next token and ends the answer
+                    self._send(cancel=self.request_id)
+                    break
+                yield reply['token']
+        finally:
+            # stop the child and drain the rest of the answer if the caller
+            # stops early, otherwise the next request would start with
+            # stale tokens
+            if reply is not None and 'token' in reply:
+                self._send(cancel=self.request_id)
+            while reply is not None and 'token' in reply:
+                reply = self._recv()
+
+    def _send(self, **kwargs):
+        self.proc.stdin.write(json.dumps(kwargs) + '\n')
+
+    def _recv(self):
+        line = self.proc.stdout.readline()
+        return json.loads(line) if line else None
+
+
+# Hands every request to the replica with the fewest requests, unless the
+# replica that generated the previous turn of the session is not busier
+# than affinity_slack requests more. That replica still holds the
+# conversation, so it does not have to process the history again.
+class ReplicaPool:
+    def __init__(self, replicas, affinity_slack=0):
+        self.replicas = replicas
+        self.affinity_slack = affinity_slack
+        self.lock = threading.Lock()
+
+    @property
+    def system_prompt(self):
+        return self.replicas[0].system_prompt
+
+    @property
+    def prompt_template(self):
+        return self.replicas[0].prompt_template
+
+    def start(self):
+        # the replicas load their models in parallel
+        for replica in self.replicas:
+            replica.start()
+        for replica in self.replicas:
+            replica.wait_ready()
+
+    def stop(self):
+        for replica in self.replicas:
+            replica.stop()
+
+    def acquire(self, affine_replica=None):
+        with self.lock:
+            replica = min(self.replicas, key=lambda r: r.load)
+            if affine_replica in self.replicas and \
+                    affine_replica.load <= replica.load + self.affinity_slack:
+                replica = affine_replica
+            replica.load += 1
+        # wait for the generation running on the replica
+        replica.busy.acquire()
+        return replica
+
+    def release(self, replica):
+        replica.busy.release()
+        with self.lock:
+            replica.load -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'replicas': len(self.replicas),
+                'busy': sum(r.load > 0 for r in self.replicas),
+                'queue_depth': sum(max(0, r.load - 1) for r in self.replicas),
+            }
+
+
+def main():
+    config = json.loads(sys.argv[1])
+    # the replies go to the real stdout, while whatever the model prints
+    # goes to stderr, so it shows up in the log of the server
+    replies = os.fdopen(os.dup(sys.stdout.fileno()), 'w',
+                        encoding='utf-8', buffering=1)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def reply(**kwargs):
+        replies.write(json.dumps(kwargs) + '\n')
+
+    if config['cores'] and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, config['cores'])
+    replica = LocalReplica(load_model(config['model_name'],
+                                      config['model_dir'],
+                                      config['infer_device'],
+                                      config['n_threads']))
+    replica.start()
+    reply(system_prompt=replica.system_prompt,
+          prompt_template=replica.prompt_template)
+
+    # stdin is read on a thread of its own, so a request can be cancelled
+    # while its answer is being generated
+    requests = queue.Queue()
+    cancelled_id = None
+
+    def read_requests():
+        nonlocal cancelled_id
+        for line in sys.stdin:
+            request = json.loads(line)
+            if 'cancel' in request:
+                cancelled_id = request['cancel']
+            else:
+                requests.put(request)
+        requests.put(None)
+
+    reader_thread = threading.Thread(target=read_requests)
+    reader_thread.daemon = True
+    reader_thread.start()
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        try:
+            for token in replica.generate(
+                    request['messages'], request['prompt'],
+                    request['max_tokens'],
+                    cancelled=lambda: cancelled_id == request['id']):
+                reply(token=token)
+        except Exception as e:
+            reply(error=f"{type(e).__name__}: {e}")
+        else:
+            reply(end=True)
+    replica.stop()
+
+
+if __name__ == '__main__':
+    main()
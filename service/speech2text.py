@@ -1,5 +1,13 @@
-from faster_whisper import WhisperModel
-from service.base import ServerBase, ClientBase
+import time
+import zlib
+import queue
+import threading
+from concurrent.futures import Future
+import numpy as np
+from service.base import ServerBase, ClientBase, MessageType
+from service.audio import AUDIO_HEADER, WHISPER_SAMPLE_RATE, SpeechSegmenter
+from service.audio import pack_pcm16, pcm16_to_whisper_input
+from service.audio import pcm16_to_float32, downmix, resample
 
 
 class Speech2TextClient(ClientBase):
@@ -10,21 +18,115 @@ class Speech2TextClient(ClientBase):
                          recv_buflen=recv_buflen)
 
     def get_text(self, wav_file_path):
-        self.socket.sendall(wav_file_path.encode('utf-8'))
-        answer = self.socket.recv(self.recv_buflen).decode('utf-8')
-        return answer
+        self._send(MessageType.TEXT, wav_file_path)
+        _, answer = self._recv()
+        return answer.decode('utf-8')
+
+    def get_text_from_pcm(self, pcm, rate, channels):
+        # send the raw 16-bit PCM audio instead of a path to a WAV file,
+        # so the server does not need to share our filesystem
+        self._send(MessageType.AUDIO, pack_pcm16(pcm, rate, channels))
+        _, answer = self._recv()
+        return answer.decode('utf-8')
+
+    def get_text_from_pcm_stream(self, pcm_chunks, rate, channels):
+        # send the audio chunk by chunk while it is still being recorded,
+        # the server transcribes every finished sentence on the fly
+        self._send(MessageType.AUDIO_STREAM, AUDIO_HEADER.pack(rate, channels))
+        self._send_stream(pcm_chunks, MessageType.AUDIO)
+        _, answer = self._recv()
+        return answer.decode('utf-8')
+
+
+# Collects the items submitted by several threads and processes them
+# together, as soon as the batch is full or the first item has waited
+# for max_wait seconds
+class MicroBatcher:
+    def __init__(self, process_batch, max_batch_size, max_wait):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = queue.Queue()
+        self.batcher_thread = threading.Thread(target=self._batch_loop)
+        self.batcher_thread.daemon = True
+        self.batcher_thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self.pending.put((item, future))
+        return future.result()
+
+    def _batch_loop(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            items = [item for item, _ in batch]
+            try:
+                results = self.process_batch(items)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                # route every result back to the thread that submitted it
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+
+
+# How repetitive a transcript is, Whisper tends to repeat itself when it
+# hallucinates
+def compression_ratio(text):
+    text_bytes = text.encode('utf-8')
+    return len(text_bytes) / len(zlib.compress(text_bytes))
 
 
 class Speech2TextServer(ServerBase):
+
+    # Whisper sees 30 s of audio at once, i.e. 3000 frames of features
+    WHISPER_CHUNK_SAMPLES = 30 * WHISPER_SAMPLE_RATE
+    WHISPER_CHUNK_FRAMES = 3000
+
+    # the defaults of WhisperModel.transcribe for telling silence and
+    # unreliable transcripts apart
+    NO_SPEECH_THRESHOLD = 0.6
+    LOG_PROB_THRESHOLD = -1.0
+    COMPRESSION_RATIO_THRESHOLD = 2.4
+
     def __init__(self,
                  model_dir, model_name="base.en",
                  infer_device='cpu', compute_type='int8',
+                 vad_filter=False, vad_threshold=0.01,
+                 max_batch_size=4, max_batch_wait=0.02,
+                 model=None,
                  ip='127.0.0.1', port=12344, recv_buflen=4096):
 
-        super().__init__(ip=ip, port=port, recv_buflen=recv_buflen)
+        # one request worker per utterance that may be in a batch
+        super().__init__(ip=ip, port=port, recv_buflen=recv_buflen,
+                         num_request_workers=max_batch_size)
+        self.vad_filter = vad_filter
+        self.vad_threshold = vad_threshold
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait
+        self.batcher = None
+
+        # a stand-in for the WhisperModel can be passed for testing
+        if model is not None:
+            self.model = model
+            return
 
         self._server_log(
             f"Loading speech-to-text model {model_name} using {infer_device}")
+        # imported here so that the clients do not load the model runtime
+        from faster_whisper import WhisperModel
+
         try:
             # we first try to use the local model
             self.model = WhisperModel(model_name, download_root=model_dir,
@@ -37,26 +139,37 @@ class Speech2TextServer(ServerBase):
                                       compute_type=compute_type,
                                       local_files_only=False)
 
-
     def run(self):
-        # Communication loop
-        while True:
-            recv_data = self.client_socket.recv(
-                self.recv_buflen).decode('utf-8')
-            self._server_log(
-                f"Received from {self.client_ip} << {recv_data}")
+        self.batcher = MicroBatcher(self._transcribe_batch,
+                                    self.max_batch_size, self.max_batch_wait)
+        super().run()
 
+    def handle_request(self, conn, msg_type, payload):
+        start = time.perf_counter()
+        if msg_type is MessageType.AUDIO_STREAM:
+            self._server_log(f"Received an audio stream from {conn.address}")
+            # only the speech after the user stopped is left to transcribe
+            speech_text, start = self._stream_speech_to_text(conn, payload)
+        elif msg_type is MessageType.AUDIO:
+            self._server_log(
+                f"Received from {conn.address} << {len(payload)} bytes audio")
+            speech_text = self._speech_to_text(
+                pcm16_to_whisper_input(payload))
+        else:
+            recv_data = payload.decode('utf-8')
+            self._server_log(f"Received from {conn.address} << {recv_data}")
             wav_file_path = recv_data
-            speech_text = self._speech_to_text(wav_file_path)
-            response = speech_text
+            from faster_whisper import decode_audio
+            speech_text = self._speech_to_text(decode_audio(wav_file_path))
+        response = speech_text
 
-            self.client_socket.send(response.encode('utf-8'))
-            self._server_log(f"Send >> {response}")
+        conn.send(MessageType.TEXT, response)
+        self.tracer.record('transcribe', conn.turn_id, start)
+        self._server_log(f"Send >> {response}")
 
-    def _speech_to_text(self, wav_file_path):
-        segments, _ = self.model.transcribe(wav_file_path)
-        segments = list(segments)
-        speech_text = ''.join([seg.text for seg in segments]).strip()
+    # audio is 16 kHz mono float32 samples
+    def _speech_to_text(self, audio):
+        speech_text = self._transcribe(audio)
 
         # deal with empty speech
         if len(speech_text) == 0:
@@ -64,6 +177,93 @@ class Speech2TextServer(ServerBase):
 
         return speech_text
 
+    def _stream_speech_to_text(self, conn, audio_header):
+        rate, channels = AUDIO_HEADER.unpack(audio_header)
+        segmenter = SpeechSegmenter(threshold=self.vad_threshold)
+
+        # transcribe every speech window as soon as the user pauses,
+        # so only the last one is left when the recording stops
+        texts = []
+        record_start = time.perf_counter()
+        for pcm in conn.iter_stream(encoding=None):
+            samples = pcm16_to_float32(np.frombuffer(pcm, dtype='<i2'))
+            samples = resample(downmix(samples, channels),
+                               rate, WHISPER_SAMPLE_RATE)
+            for window in segmenter.feed(samples):
+                texts.append(self._transcribe(window))
+        stream_end = time.perf_counter()
+        self.tracer.record('record', conn.turn_id, record_start, stream_end)
+        tail = segmenter.flush()
+        if tail is not None:
+            texts.append(self._transcribe(tail))
+
+        speech_text = ' '.join(text for text in texts if text)
+        if len(speech_text) == 0:
+            speech_text = "[EMPTY SPEECH]"
+        return speech_text, stream_end
+
+    def _transcribe(self, audio):
+        # wait for the utterances of the other connections to be batched
+        return self.batcher.submit(audio)
+
+    def _transcribe_batch(self, audios):
+        # Utterances longer than one Whisper window need the sliding window
+        # of WhisperModel.transcribe, and so does the language detection of
+        # the multilingual models
+        if len(audios) == 1 or self.vad_filter \
+                or self.model.model.is_multilingual \
+                or any(len(a) > self.WHISPER_CHUNK_SAMPLES for a in audios):
+            return [self._transcribe_one(audio) for audio in audios]
+
+        import ctranslate2
+        from faster_whisper.tokenizer import Tokenizer
+
+        features = np.stack([self._log_mel(audio) for audio in audios])
+        tokenizer = Tokenizer(self.model.hf_tokenizer,
+                              self.model.model.is_multilingual,
+                              task='transcribe', language='en')
+        prompt = tokenizer.sot_sequence + [tokenizer.no_timestamps]
+        results = self.model.model.generate(
+            ctranslate2.StorageView.from_array(features),
+            [prompt] * len(audios),
+            beam_size=5, max_length=448,
+            suppress_blank=True, suppress_tokens=[-1],
+            return_scores=True, return_no_speech_prob=True)
+
+        # The batch is decoded once at temperature 0 and without timestamps.
+        # WhisperModel.transcribe drops the silent windows and decodes the
+        # unreliable ones again at higher temperatures, so we drop the same
+        # windows and transcribe the unreliable ones on their own.
+        texts = []
+        for audio, result in zip(audios, results):
+            tokens = result.sequences_ids[0]
+            text = tokenizer.decode(tokens).strip()
+            # the score is the log probability divided by the length
+            avg_logprob = result.scores[0] * len(tokens) / (len(tokens) + 1)
+            if avg_logprob >= self.LOG_PROB_THRESHOLD \
+                    and compression_ratio(text) \
+                    <= self.COMPRESSION_RATIO_THRESHOLD:
+                texts.append(text)
+            elif result.no_speech_prob > self.NO_SPEECH_THRESHOLD \
+                    and avg_logprob < self.LOG_PROB_THRESHOLD:
+                texts.append('')
+            else:
+                texts.append(self._transcribe_one(audio))
+        return texts
+
+    def _transcribe_one(self, audio):
+        segments, _ = self.model.transcribe(audio, vad_filter=self.vad_filter)
+        segments = list(segments)
+        return ''.join([seg.text for seg in segments]).strip()
+
+    def _log_mel(self, audio):
+        # exactly one Whisper window of features per utterance,
+        # padded with silence like WhisperModel.transcribe does
+        audio = np.pad(audio, (0, self.WHISPER_CHUNK_SAMPLES - len(audio)))
+        features = self.model.feature_extractor(audio)
+        features = features[:, :self.WHISPER_CHUNK_FRAMES]
+        return np.ascontiguousarray(features, dtype=np.float32)
+
 
 if __name__ == '__main__':
     sts = Speech2TextServer()
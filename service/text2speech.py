@@ -1,12 +1,304 @@
 import os
+import re
+import json
+import time
+import queue
 import asyncio
+import shutil
+import hashlib
 import platform
 import tempfile
+import threading
+import subprocess
 from pathlib import Path
-import pyttsx3
-import edge_tts
-from playsound import playsound
-from service.base import ServerBase, ClientBase
+from collections import OrderedDict
+from service.base import ServerBase, ClientBase, MessageType
+from service.audio import AUDIO_HEADER
+
+
+# abbreviations whose period does not end the sentence
+ABBREVIATIONS = ['Mr', 'Mrs', 'Ms', 'Dr', 'Prof', 'St', 'Jr', 'Sr', 'vs',
+                 'e.g', 'i.e']
+
+# a sentence ends with a punctuation mark followed by whitespace, or with
+# a line break. After a period, the next sentence must not start with a
+# lowercase letter, so the boundary is only known once it has arrived.
+SENTENCE_BOUNDARY = re.compile(
+    r'(?<=[!?;:])\s+'
+    + '|' + ''.join(rf'(?<!\b{re.escape(abbreviation)}\.)'
+                    for abbreviation in ABBREVIATIONS)
+    + r'(?<=\.)\s+(?=[^\sa-z])'
+    + r'|\n+')
+
+
+def iter_sentences(chunks):
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        *sentences, buffer = SENTENCE_BOUNDARY.split(buffer)
+        for sentence in sentences:
+            if sentence.strip():
+                yield sentence.strip()
+    if buffer.strip():
+        yield buffer.strip()
+
+
+# Synthesized audio is stored on disk under the hash of (engine, voice, text),
+# the most recently used entries are also kept in memory. Both levels drop
+# the least recently used entries when they are full.
+class SpeechCache:
+    def __init__(self, cache_dir,
+                 max_disk_bytes=256 * 1024 * 1024, max_memory_items=64):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_items = max_memory_items
+        self.memory = OrderedDict()  # key -> audio
+        self.disk = OrderedDict()  # key -> size of the file
+        self.disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        # restore the LRU order from the modification time of the files
+        os.makedirs(cache_dir, exist_ok=True)
+        entries = [e for e in os.scandir(cache_dir)
+                   if e.is_file() and not e.name.endswith('.tmp')]
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            self.disk[entry.name] = entry.stat().st_size
+            self.disk_bytes += entry.stat().st_size
+
+    @staticmethod
+    def key(engine, voice, text):
+        key_data = json.dumps([engine, voice, text]).encode('utf-8')
+        return hashlib.sha256(key_data).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+
+            if key in self.disk:
+                path = os.path.join(self.cache_dir, key)
+                try:
+                    with open(path, 'rb') as fp:
+                        audio = fp.read()
+                    os.utime(path)
+                except OSError:
+                    self.disk_bytes -= self.disk.pop(key)
+                else:
+                    self.disk.move_to_end(key)
+                    self._remember(key, audio)
+                    self.hits += 1
+                    return audio
+
+            self.misses += 1
+            return None
+
+    def put(self, key, audio):
+        with self.lock:
+            path = os.path.join(self.cache_dir, key)
+            with open(path + '.tmp', 'wb') as fp:
+                fp.write(audio)
+            os.replace(path + '.tmp', path)
+            if key in self.disk:
+                self.disk_bytes -= self.disk.pop(key)
+            self.disk[key] = len(audio)
+            self.disk_bytes += len(audio)
+            while self.disk_bytes > self.max_disk_bytes and len(self.disk) > 1:
+                old_key, old_size = self.disk.popitem(last=False)
+                self.disk_bytes -= old_size
+                try:
+                    os.remove(os.path.join(self.cache_dir, old_key))
+                except OSError:
+                    pass
+            self._remember(key, audio)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'memory_items': len(self.memory),
+                'disk_items': len(self.disk),
+                'disk_bytes': self.disk_bytes,
+            }
+
+    def _remember(self, key, audio):
+        self.memory[key] = audio
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+
+# Audio chunks written by the synthesizer while they are being played
+class AudioStream:
+    def __init__(self):
+        self.chunks = queue.Queue()
+        self.data = bytearray()
+        self.error = None
+        # set as soon as the first chunk (or the end of the stream) arrives
+        self.ready = threading.Event()
+        self.complete = False
+        self.on_complete = None
+        self.lock = threading.Lock()
+
+    def write(self, chunk):
+        self.data += chunk
+        self.chunks.put(chunk)
+        self.ready.set()
+
+    def close(self, error=None):
+        with self.lock:
+            self.error = error
+            self.complete = error is None
+            on_complete = self.on_complete
+        # the audio is stored before the reader sees the end of the stream
+        if self.complete and on_complete:
+            on_complete(bytes(self.data))
+        self.chunks.put(None)
+        self.ready.set()
+
+    # callback(data) gets the whole audio once the stream has arrived, or
+    # right away if it already has; a failed stream never calls it
+    def when_complete(self, callback):
+        with self.lock:
+            self.on_complete = callback
+            complete = self.complete
+        if complete:
+            callback(bytes(self.data))
+
+    # yields the chunks as they arrive, then raises the error if the
+    # synthesis has failed
+    def __iter__(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+
+# Plays the audio by piping it into a command line player, so the playback
+# starts with the first chunk
+class PipePlayer:
+    def __init__(self, command):
+        self.command = command
+        self.proc = None
+
+    def play(self, audio):
+        chunks = [audio] if isinstance(audio, bytes) else audio
+        proc = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        self.proc = proc
+        try:
+            for chunk in chunks:
+                proc.stdin.write(chunk)
+                proc.stdin.flush()
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        except Exception:
+            # the audio broke off, e.g. the synthesis failed
+            proc.kill()
+            raise
+        finally:
+            proc.wait()
+            self.proc = None
+
+    def stop(self):
+        proc = self.proc
+        if proc:
+            proc.kill()
+
+
+# Plays the audio with playsound, which needs the whole file first
+class FilePlayer:
+    def __init__(self, suffix='.mp3'):
+        self.suffix = suffix
+
+    def play(self, audio):
+        from playsound import playsound
+
+        chunks = [audio] if isinstance(audio, bytes) else audio
+        audio_fp, audio_path = tempfile.mkstemp(suffix=self.suffix)
+        try:
+            with os.fdopen(audio_fp, 'wb') as fp:
+                for chunk in chunks:
+                    fp.write(chunk)
+        except Exception:
+            os.remove(audio_path)
+            raise
+
+        # To solve playsound issue: a problem occurred in initializing MCI
+        # the file must be closed before it is played
+        if platform.system() == 'Windows':
+            playsound(Path(audio_path).as_uri())
+        else:
+            playsound(audio_path)
+        os.remove(audio_path)
+
+    def stop(self):
+        # playsound can not be interrupted, the sentence is played to the end
+        pass
+
+
+# Decodes compressed audio chunks to 16-bit mono PCM with ffmpeg while they
+# come in; on_pcm is called from a reader thread with the decoded bytes
+class PcmDecoder:
+    def __init__(self, on_pcm, rate=16000):
+        self.rate = rate
+        self.on_pcm = on_pcm
+        self.proc = subprocess.Popen(
+            ['ffmpeg', '-loglevel', 'quiet', '-i', 'pipe:0',
+             '-f', 's16le', '-ac', '1', '-ar', str(rate), 'pipe:1'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        self.reader_thread = threading.Thread(target=self._read_pcm)
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+
+    def write(self, chunk):
+        try:
+            self.proc.stdin.write(chunk)
+            self.proc.stdin.flush()
+        except BrokenPipeError:
+            pass
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.reader_thread.join()
+        self.proc.wait()
+
+    def _read_pcm(self):
+        rest = b''
+        while True:
+            data = os.read(self.proc.stdout.fileno(), 8192)
+            if not data:
+                break
+            # never split a 16-bit sample
+            data = rest + data
+            cut = len(data) - len(data) % 2
+            rest = data[cut:]
+            if cut:
+                self.on_pcm(data[:cut])
+
+
+def default_player():
+    if shutil.which('ffplay'):
+        return PipePlayer(['ffplay', '-nodisp', '-autoexit',
+                           '-loglevel', 'quiet', '-i', '-'])
+    if shutil.which('mpv'):
+        return PipePlayer(['mpv', '--no-video', '--really-quiet', '-'])
+    return FilePlayer()
 
 
 class Text2SpeechClient(ClientBase):
@@ -16,99 +308,266 @@ class Text2SpeechClient(ClientBase):
         super().__init__(server_ip=server_ip, server_port=server_port,
                          recv_buflen=recv_buflen)
 
-    def read_aloud(self, text):
-        self.socket.sendall(text.encode('utf-8'))
-        start_reading = self.socket.recv(self.recv_buflen).decode('utf-8')
-        yield start_reading
-        finish_reading = self.socket.recv(self.recv_buflen).decode('utf-8')
+    # on_audio(msg_type, payload) receives the audio being read, as an
+    # AUDIO_STREAM header, AUDIO chunks of PCM and END for every sentence
+    def read_aloud(self, text, on_audio=None):
+        sender_thread = None
+        if isinstance(text, str):
+            self._send(MessageType.TEXT, text)
+        else:
+            # keep forwarding the text stream while the server is reading
+            sender_thread = threading.Thread(
+                target=self._send_stream, args=(text,))
+            sender_thread.daemon = True
+            sender_thread.start()
+
+        try:
+            start_reading = self._recv_status(on_audio)
+            yield start_reading
+            finish_reading = self._recv_status(on_audio)
+        finally:
+            # the rest of the text stream goes out before the next request,
+            # even if the reading has failed
+            if sender_thread:
+                sender_thread.join()
         yield finish_reading
 
+    def _recv_status(self, on_audio):
+        while True:
+            msg_type, payload = self._recv()
+            if msg_type is MessageType.STATUS:
+                return payload.decode('utf-8')
+            if on_audio:
+                on_audio(msg_type, payload)
+
 
 class Text2SpeechServerBase(ServerBase):
+    # how many synthesized sentences may wait for being played
+    PREFETCH_SENTENCES = 2
+    # whether _synthesize() returns audio bytes, which can be cached and
+    # decoded for the lip sync of the avatar
+    SYNTHESIZES_AUDIO = False
+
     def __init__(self,
-                 voice="",
+                 voice="", cache_dir=None, lip_sync=True,
                  ip='127.0.0.1', port=12347, recv_buflen=4096):
 
         super().__init__(ip=ip, port=port, recv_buflen=recv_buflen)
         self.voice = voice
+        self.cache = None
+        if cache_dir and self.SYNTHESIZES_AUDIO:
+            self.cache = SpeechCache(cache_dir)
+        self.lip_sync = lip_sync and self.SYNTHESIZES_AUDIO \
+            and shutil.which('ffmpeg') is not None
+        # the turn whose text is being read aloud
+        self.reading_turn = None
 
-    def run(self):
-        # Communication loop
-        while True:
-            recv_data = self.client_socket.recv(
-                self.recv_buflen).decode('utf-8')
-            self._server_log(
-                f"Received from {self.client_ip} << {recv_data}")
+    def handle_request(self, conn, msg_type, payload):
+        if msg_type is MessageType.TOKEN:
+            self._server_log(f"Received a text stream from {conn.address}")
+            text = conn.iter_stream(payload)
+        else:
+            text = [payload.decode('utf-8')]
+            self._server_log(f"Received from {conn.address} << {text[0]}")
 
-            self._text_to_speech(recv_data)
+        self._text_to_speech(conn, iter_sentences(text))
 
-    def _text_to_speech(self, text):
-        response = '[START READING]'
-        self.client_socket.send(response.encode('utf-8'))
-        self._server_log(f"Send >> {response}")
+    def _text_to_speech(self, conn, sentences):
+        start = time.perf_counter()
+        self.reading_turn = conn.turn_id
+        # sentence N+1 is synthesized while sentence N is being played
+        audios = queue.Queue(maxsize=self.PREFETCH_SENTENCES)
+
+        # the first error of synthesize() or of the playback
+        errors = []
+
+        def synthesize():
+            try:
+                for sentence in sentences:
+                    # the rest of the text is still read to keep the stream
+                    # in sync, but no longer synthesized
+                    if errors or self.is_cancelled(conn.turn_id):
+                        continue
+                    with self.tracer.span('synthesis', conn.turn_id):
+                        audio = self._synthesize_cached(sentence)
+                    audios.put(audio)
+            except Exception as e:
+                errors.append(e)
+                # the chunks left on the connection would be taken for the
+                # next requests
+                for _ in sentences:
+                    pass
+            finally:
+                audios.put(None)
+
+        synthesize_thread = threading.Thread(target=synthesize)
+        synthesize_thread.daemon = True
+        synthesize_thread.start()
+
+        is_reading = False
+        try:
+            while True:
+                audio = audios.get()
+                if audio is None:
+                    break
+                if errors or self.is_cancelled(conn.turn_id):
+                    continue
+                if not is_reading:
+                    is_reading = True
+                    self._send_status(conn, '[START READING]')
+                    self.tracer.record('playback_start', conn.turn_id, start)
+                if self.lip_sync:
+                    audio = self._tap_audio(conn, audio)
+                self._play(audio)
+        except Exception as e:
+            errors.append(e)
+            # let synthesize() read the rest of the text
+            while audios.get() is not None:
+                pass
+        finally:
+            synthesize_thread.join()
+            self.reading_turn = None
+
+        # the request worker replies with the error
+        if errors:
+            raise errors[0]
+
+        # nothing to read, but the client still expects both status
+        if not is_reading:
+            self._send_status(conn, '[START READING]')
+        self._send_status(conn, '[FINISH READING]')
+
+        if self.cache:
+            self._server_log(f"Speech cache: {self.cache.stats()}")
+
+    def _synthesize_cached(self, sentence):
+        if self.cache is None:
+            return self._synthesize(sentence)
+
+        # a cache hit skips the synthesis entirely
+        key = SpeechCache.key(self.__class__.__name__, self.voice, sentence)
+        audio = self.cache.get(key)
+        if audio is None:
+            audio = self._synthesize(sentence)
+            if isinstance(audio, AudioStream):
+                # cache the audio once the whole stream has arrived
+                audio.when_complete(lambda data: self.cache.put(key, data))
+            else:
+                self.cache.put(key, audio)
+        return audio
+
+    # Pass the audio on to the player and send its PCM to the client at the
+    # same time, so the client (ActionServer) can move the avatar's mouth
+    def _tap_audio(self, conn, audio):
+        chunks = [audio] if isinstance(audio, bytes) else audio
+        decoder = PcmDecoder(lambda pcm: conn.send(MessageType.AUDIO, pcm))
+        conn.send(MessageType.AUDIO_STREAM,
+                  AUDIO_HEADER.pack(decoder.rate, 1))
+        try:
+            for chunk in chunks:
+                decoder.write(chunk)
+                yield chunk
+        finally:
+            decoder.close()
+            conn.send(MessageType.END)
+
+    def handle_cancel(self, turn_id):
+        if turn_id == self.reading_turn:
+            self._stop_playback()
+
+    def _synthesize(self, sentence):
+        return sentence
+
+    def _play(self, audio):
+        pass
+
+    def _stop_playback(self):
         pass
-        response = '[FINISH READING]'
-        self.client_socket.send(response.encode('utf-8'))
+
+    def _send_status(self, conn, response):
+        conn.send(MessageType.STATUS, response)
         self._server_log(f"Send >> {response}")
 
 
 class Pyttsx3Server(Text2SpeechServerBase):
-    def _text_to_speech(self, text):
-        response = '[START READING]'
-        self.client_socket.send(response.encode('utf-8'))
-        self._server_log(f"Send >> {response}")
+    engine = None
 
-        pyttsx3.speak(text)
+    # pyttsx3 synthesizes and plays the speech in one go
+    def _play(self, audio):
+        import pyttsx3
+        self.engine = pyttsx3.init()
+        self.engine.say(audio)
+        self.engine.runAndWait()
 
-        response = '[FINISH READING]'
-        self.client_socket.send(response.encode('utf-8'))
-        self._server_log(f"Send >> {response}")
+    def _stop_playback(self):
+        if self.engine:
+            self.engine.stop()
 
 
 class EdgettsServer(Text2SpeechServerBase):
+    SYNTHESIZES_AUDIO = True
+
     def __init__(self,
-                 voice="en-US-AriaNeural",
+                 voice="en-US-AriaNeural", cache_dir=None, lip_sync=True,
+                 player=None, communicate_class=None,
                  ip='127.0.0.1', port=12347, recv_buflen=4096):
 
-        super().__init__(voice=voice,
+        super().__init__(voice=voice, cache_dir=cache_dir, lip_sync=lip_sync,
                          ip=ip, port=port, recv_buflen=recv_buflen)
+        # anything with play(audio), where audio is bytes or byte chunks,
+        # and stop() to interrupt it
+        self.player = player or default_player()
+        # a stand-in for edge_tts.Communicate can be passed for testing
+        if communicate_class is None:
+            import edge_tts
+            communicate_class = edge_tts.Communicate
+        self.communicate_class = communicate_class
+        self.loop = None
+        self.loop_thread = None
 
-    def _text_to_speech(self, text):
-        async def amain(text, voice, output_file):
-            communicate = edge_tts.Communicate(text, voice)
-            await communicate.save(output_file)
-
-        mp3_fp, mp3_path = tempfile.mkstemp(suffix='.mp3')
-
+    def run(self):
         # https://stackoverflow.com/a/70758881/15283141
         if platform.system() == 'Windows':
             asyncio.set_event_loop_policy(
                 asyncio.WindowsSelectorEventLoopPolicy())
-        else:
-            # https://stackoverflow.com/a/45600858
-            asyncio.set_event_loop(asyncio.new_event_loop())
 
-        loop = asyncio.get_event_loop_policy().get_event_loop()
-        try:
-            loop.run_until_complete(amain(text, self.voice, mp3_path))
-        finally:
-            loop.close()
+        # one event loop in the background for the whole life of the server
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever)
+        self.loop_thread.daemon = True
+        self.loop_thread.start()
 
-        response = '[START READING]'
-        self.client_socket.send(response.encode('utf-8'))
-        self._server_log(f"Send >> {response}")
+        super().run()
 
-        # To solve playsound issue: a problem occurred in initializing MCI
-        os.close(mp3_fp)
-        if platform.system() == 'Windows':
-            playsound(Path(mp3_path).as_uri())
-        else:
-            playsound(mp3_path)
-        os.remove(mp3_path)
+    def _synthesize(self, sentence):
+        audio = AudioStream()
 
-        response = '[STOP READING]'
-        self.client_socket.send(response.encode('utf-8'))
-        self._server_log(f"Send >> {response}")
+        async def amain(text, voice):
+            try:
+                communicate = self.communicate_class(text, voice)
+                async for chunk in communicate.stream():
+                    if chunk["type"] == "audio":
+                        audio.write(chunk["data"])
+            except Exception as e:
+                self._server_log(f"Failed to synthesize '{text}' ({e})")
+                audio.close(e)
+            else:
+                audio.close()
+
+        asyncio.run_coroutine_threadsafe(
+            amain(sentence, self.voice), self.loop)
+        # the reading starts when the first chunk is there, the rest of the
+        # sentence is synthesized while it is being played
+        audio.ready.wait()
+        if audio.error is not None and not audio.data:
+            raise audio.error
+        return audio
+
+    def _play(self, audio):
+        self.player.play(audio)
+
+    def _stop_playback(self):
+        self.player.stop()
 
 
 if __name__ == '__main__':
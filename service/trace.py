@@ -0,0 +1,132 @@
+import json
+import time
+import uuid
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+# The spans of one conversation turn, in pipeline order:
+#   record          the user speaking, until the audio stream ends
+#   transcribe      the end of the speech until its text is sent
+#   first_token     the prompt until the first token of the answer
+#   generation      the prompt until the whole answer is generated
+#   synthesis       one sentence of text until its audio is ready
+#   playback_start  the first text until its speech starts playing
+#   action_done     the answer until the avatar is idle again
+#   turn            the prompt until the whole reaction is done
+
+PERCENTILES = (50, 95, 99)
+
+
+def new_turn_id():
+    return uuid.uuid4().hex[:12]
+
+
+def percentile(sorted_values, q):
+    # nearest-rank percentile, good enough for a latency summary
+    index = max(0, -(-len(sorted_values) * q // 100) - 1)
+    return sorted_values[int(index)]
+
+
+# Keeps the most recent durations of every span, so the percentiles
+# follow the current behaviour of a long running service
+class LatencyHistogram:
+    def __init__(self, max_samples=1024):
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, duration):
+        with self.lock:
+            self.samples.append(duration)
+            self.count += 1
+
+    def percentiles(self, qs=PERCENTILES):
+        with self.lock:
+            values = sorted(self.samples)
+        if not values:
+            return {}
+        return {q: percentile(values, q) for q in qs}
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+            return self.histograms[name]
+
+    def snapshot(self):
+        with self.lock:
+            histograms = dict(self.histograms)
+        return {name: {'count': histogram.count,
+                       **{f'p{q}': value for q, value
+                          in histogram.percentiles().items()}}
+                for name, histogram in histograms.items()}
+
+    def summary(self):
+        lines = []
+        for name, stats in self.snapshot().items():
+            percentiles = ' '.join(
+                f"p{q}={stats[f'p{q}'] * 1000:.0f}ms" for q in PERCENTILES)
+            lines.append(f"{name}: n={stats['count']} {percentiles}")
+        return '; '.join(lines)
+
+
+# Appends every span as one JSON object per line. The servers run in their
+# own processes, so the file is opened in append mode by each of them.
+class JsonLinesSink:
+    def __init__(self, path):
+        self.file = open(path, 'a', buffering=1, encoding='utf-8')
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+# every process has a registry of its own, the sink is optional
+metrics = MetricsRegistry()
+_sink = None
+
+
+def configure(trace_file=None):
+    global _sink
+    if _sink:
+        _sink.close()
+    _sink = JsonLinesSink(trace_file) if trace_file else None
+
+
+class Tracer:
+    def __init__(self, service):
+        self.service = service
+
+    # start is a time.perf_counter() value
+    def record(self, name, turn_id, start, end=None):
+        now = time.perf_counter()
+        if end is None:
+            end = now
+        duration = end - start
+        metrics.histogram(name).add(duration)
+        if _sink:
+            # wall clock time, which all the processes agree on
+            _sink.write({'turn': turn_id, 'service': self.service,
+                         'span': name, 'start': time.time() - (now - start),
+                         'duration': duration})
+
+    @contextmanager
+    def span(self, name, turn_id):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, turn_id, start)
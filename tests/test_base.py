@@ -0,0 +1,127 @@
+import socket
+import threading
+import unittest
+
+from service.base import MESSAGE_HEADER, MAX_PAYLOAD_LEN, MessageType
+from service.base import ProtocolError, ServerBase, ClientBase
+from service.base import send_message, recv_message
+
+
+# Replies to every TEXT request with the same text, and to a request
+# starting with "twice" with two STATUS messages in one send
+class EchoServer(ServerBase):
+    def __init__(self, port):
+        super().__init__(ip='127.0.0.1', port=port, recv_buflen=4096)
+        self.disconnected = threading.Event()
+
+    def handle_request(self, conn, msg_type, payload):
+        text = payload.decode('utf-8')
+        if text.startswith('twice'):
+            with conn.send_lock:
+                conn.socket.sendall(
+                    MESSAGE_HEADER.pack(MessageType.STATUS, 5) + b'[ONE]'
+                    + MESSAGE_HEADER.pack(MessageType.STATUS, 5) + b'[TWO]')
+        else:
+            conn.send(MessageType.TEXT, text)
+
+    def handle_disconnect(self, conn):
+        self.disconnected.set()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class MessageFramingTest(unittest.TestCase):
+    def setUp(self):
+        self.left, self.right = socket.socketpair()
+
+    def tearDown(self):
+        self.left.close()
+        self.right.close()
+
+    def test_receives_a_payload_larger_than_the_buffer(self):
+        text = 'x' * 100000
+        sender = threading.Thread(
+            target=send_message, args=(self.left, MessageType.TEXT, text))
+        sender.start()
+        msg_type, payload = recv_message(self.right, recv_buflen=4096)
+        sender.join()
+        self.assertIs(msg_type, MessageType.TEXT)
+        self.assertEqual(payload.decode('utf-8'), text)
+
+    def test_separates_messages_arriving_in_one_read(self):
+        self.left.sendall(
+            MESSAGE_HEADER.pack(MessageType.STATUS, 15) + b'[START READING]'
+            + MESSAGE_HEADER.pack(MessageType.STATUS, 16)
+            + b'[FINISH READING]')
+        self.assertEqual(recv_message(self.right),
+                         (MessageType.STATUS, b'[START READING]'))
+        self.assertEqual(recv_message(self.right),
+                         (MessageType.STATUS, b'[FINISH READING]'))
+
+    def test_refuses_an_unknown_message_type(self):
+        self.left.sendall(MESSAGE_HEADER.pack(200, 0))
+        with self.assertRaises(ProtocolError):
+            recv_message(self.right)
+
+    def test_refuses_a_too_large_payload(self):
+        # nothing follows the header, the length alone is refused
+        self.left.sendall(
+            MESSAGE_HEADER.pack(MessageType.AUDIO, MAX_PAYLOAD_LEN + 1))
+        with self.assertRaises(ProtocolError):
+            recv_message(self.right)
+
+
+class ServerBaseTest(unittest.TestCase):
+    def setUp(self):
+        self.server = EchoServer(free_port())
+        self.server.connect()
+        thread = threading.Thread(target=self.server.run)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.tcp_server.shutdown()
+
+    def connect(self):
+        client = ClientBase('127.0.0.1', self.server.port, 4096)
+        client.connect(max_retry=50, wait_time=0.1)
+        return client
+
+    def test_replies_larger_than_the_buffer(self):
+        client = self.connect()
+        text = 'answer ' * 2000
+        client._send(MessageType.TEXT, text)
+        msg_type, payload = client._recv()
+        self.assertEqual(payload.decode('utf-8'), text)
+
+    def test_back_to_back_status_messages(self):
+        client = self.connect()
+        client._send(MessageType.TEXT, 'twice')
+        self.assertEqual(client._recv(), (MessageType.STATUS, b'[ONE]'))
+        self.assertEqual(client._recv(), (MessageType.STATUS, b'[TWO]'))
+
+    def test_closes_a_connection_sending_garbage(self):
+        for header in (MESSAGE_HEADER.pack(200, 0),
+                       MESSAGE_HEADER.pack(MessageType.TEXT,
+                                           MAX_PAYLOAD_LEN + 1)):
+            self.server.disconnected.clear()
+            with socket.create_connection(
+                    ('127.0.0.1', self.server.port)) as sock:
+                sock.sendall(header)
+                self.assertTrue(self.server.disconnected.wait(5))
+                # the server has closed its end
+                sock.settimeout(5)
+                self.assertEqual(sock.recv(1), b'')
+
+        # and keeps serving the other clients
+        client = self.connect()
+        client._send(MessageType.TEXT, 'still here')
+        self.assertEqual(client._recv(), (MessageType.TEXT, b'still here'))
+
+
+if __name__ == '__main__':
+    unittest.main()
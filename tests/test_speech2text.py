@@ -0,0 +1,136 @@
+import sys
+import types
+import socket
+import threading
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from service.speech2text import Speech2TextServer, Speech2TextClient
+
+
+# A stand-in for the CTranslate2 Whisper model of a WhisperModel. Every
+# utterance is a constant signal and its transcript is its amplitude, so
+# a transcript sent to the wrong connection shows.
+class FakeWhisper:
+    is_multilingual = False
+    # utterances the model is unsure about, and utterances of silence
+    UNRELIABLE = {6}
+    SILENT = {7}
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def generate(self, features, prompts, **options):
+        self.batch_sizes.append(len(prompts))
+        results = []
+        for feature in features:
+            utterance = round(feature[0, 0] * 32768 / 1000)
+            unsure = utterance in self.UNRELIABLE | self.SILENT
+            results.append(types.SimpleNamespace(
+                sequences_ids=[[utterance]],
+                scores=[-3.0 if unsure else -0.1],
+                no_speech_prob=0.9 if utterance in self.SILENT else 0.01))
+        return results
+
+
+class FakeWhisperModel:
+    def __init__(self):
+        self.model = FakeWhisper()
+        self.hf_tokenizer = None
+        self.transcribed = []
+
+    def feature_extractor(self, audio):
+        return np.full((80, 3001), audio[0])
+
+    # the full transcription, with its fallback to higher temperatures
+    def transcribe(self, audio, vad_filter=False):
+        utterance = round(audio[0] * 32768 / 1000)
+        self.transcribed.append(utterance)
+        segment = types.SimpleNamespace(text=f" utterance {utterance} again")
+        return iter([segment]), None
+
+
+class FakeTokenizer:
+    sot_sequence = [1]
+    no_timestamps = 2
+
+    def __init__(self, hf_tokenizer, multilingual, task, language):
+        pass
+
+    def decode(self, tokens):
+        return ''.join(f" utterance {token}" for token in tokens)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class BatchedTranscriptionTest(unittest.TestCase):
+    def setUp(self):
+        # the batched path only needs these two names from the runtime
+        ctranslate2 = types.ModuleType('ctranslate2')
+        ctranslate2.StorageView = types.SimpleNamespace(
+            from_array=lambda array: array)
+        tokenizer = types.ModuleType('faster_whisper.tokenizer')
+        tokenizer.Tokenizer = FakeTokenizer
+        modules = mock.patch.dict(sys.modules, {
+            'ctranslate2': ctranslate2,
+            'faster_whisper': types.ModuleType('faster_whisper'),
+            'faster_whisper.tokenizer': tokenizer})
+        modules.start()
+        self.addCleanup(modules.stop)
+
+        self.model = FakeWhisperModel()
+        # the batch is full long before the first utterance has waited
+        self.server = Speech2TextServer(model_dir=None, model=self.model,
+                                        max_batch_size=4, max_batch_wait=5,
+                                        port=free_port())
+        self.server.connect()
+        thread = threading.Thread(target=self.server.run)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.tcp_server.shutdown()
+
+    # sends one second of every utterance from its own connection at once
+    def transcribe(self, utterances):
+        answers = {}
+
+        def send(utterance):
+            client = Speech2TextClient(server_port=self.server.port)
+            client.connect(max_retry=50, wait_time=0.1)
+            pcm = np.full(16000, utterance * 1000, dtype='<i2').tobytes()
+            answers[utterance] = client.get_text_from_pcm(pcm, 16000, 1)
+
+        threads = [threading.Thread(target=send, args=(utterance,))
+                   for utterance in utterances]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        return answers
+
+    def test_routes_every_transcript_to_its_connection(self):
+        answers = self.transcribe([1, 2, 3, 4])
+        self.assertEqual(answers, {utterance: f"utterance {utterance}"
+                                   for utterance in [1, 2, 3, 4]})
+        self.assertEqual(self.model.model.batch_sizes, [4])
+        self.assertEqual(self.model.transcribed, [])
+
+    def test_falls_back_like_the_full_transcription(self):
+        answers = self.transcribe([5, 6, 7, 8])
+        self.assertEqual(answers, {5: "utterance 5",
+                                   6: "utterance 6 again",
+                                   7: "[EMPTY SPEECH]",
+                                   8: "utterance 8"})
+        self.assertEqual(self.model.model.batch_sizes, [4])
+        self.assertEqual(self.model.transcribed, [6])
+
+
+if __name__ == '__main__':
+    unittest.main()
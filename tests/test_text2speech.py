@@ -0,0 +1,170 @@
+import os
+import socket
+import asyncio
+import tempfile
+import threading
+import unittest
+
+from service.base import ServiceError
+from service.text2speech import EdgettsServer, Text2SpeechClient
+from service.text2speech import iter_sentences
+
+
+# A stand-in for edge_tts.Communicate yielding a few audio chunks at once.
+# With wait_for_player, it waits after the first chunk until the player
+# has it, which shows that the playback starts before the synthesis ends.
+class FakeCommunicate:
+    CHUNKS = [b'chunk-1;', b'chunk-2;', b'chunk-3;']
+    calls = 0
+    wait_for_player = False
+    # fail after this many chunks, e.g. when the network is down
+    fail_after = None
+
+    def __init__(self, text, voice):
+        self.text = text
+        self.finished = False
+        self.first_chunk_played = threading.Event()
+        FakeCommunicate.calls += 1
+        FakeCommunicate.last = self
+
+    async def stream(self):
+        yield {"type": "WordBoundary"}
+        for index, chunk in enumerate(self.CHUNKS):
+            if index == self.fail_after:
+                raise ConnectionError("Cannot connect to the service")
+            yield {"type": "audio", "data": chunk}
+            if index == 0 and self.wait_for_player:
+                for _ in range(100):
+                    if self.first_chunk_played.is_set():
+                        break
+                    await asyncio.sleep(0.01)
+        self.finished = True
+
+
+# Collects the played audio instead of playing it
+class RecordingPlayer:
+    def __init__(self):
+        self.played = []
+        self.streamed = []
+
+    def play(self, audio):
+        chunks = [audio] if isinstance(audio, bytes) else audio
+        data = b''
+        for chunk in chunks:
+            # cached audio comes as bytes, synthesized audio as a stream
+            if not data and not isinstance(audio, bytes):
+                communicate = FakeCommunicate.last
+                self.streamed.append(not communicate.finished)
+                communicate.first_chunk_played.set()
+            data += chunk
+        self.played.append(data)
+
+    def stop(self):
+        pass
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class IterSentencesTest(unittest.TestCase):
+    def test_splits_the_streamed_tokens_into_sentences(self):
+        tokens = ['Hello', ' there', '.', ' How', ' are', ' you?', ' Fine',
+                  '; thanks', '!\n', 'Bye']
+        self.assertEqual(list(iter_sentences(tokens)),
+                         ['Hello there.', 'How are you?', 'Fine;',
+                          'thanks!', 'Bye'])
+
+    def test_keeps_abbreviations_in_the_sentence(self):
+        tokens = ['Ask', ' Dr', '.', ' Smith', ' about', ' fruit', ',',
+                  ' e', '.g', '.', ' apples', '.', ' It', ' is', ' 3',
+                  ' p', '.m', '. now', '.']
+        self.assertEqual(list(iter_sentences(tokens)),
+                         ['Ask Dr. Smith about fruit, e.g. apples.',
+                          'It is 3 p.m. now.'])
+
+
+class EdgettsServerTest(unittest.TestCase):
+    def setUp(self):
+        FakeCommunicate.calls = 0
+        FakeCommunicate.last = None
+        FakeCommunicate.wait_for_player = False
+        FakeCommunicate.fail_after = None
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.tcp_server.shutdown()
+            server.loop.call_soon_threadsafe(server.loop.stop)
+        self.cache_dir.cleanup()
+
+    def start_server(self):
+        player = RecordingPlayer()
+        server = EdgettsServer(cache_dir=self.cache_dir.name, lip_sync=False,
+                               player=player,
+                               communicate_class=FakeCommunicate,
+                               port=free_port())
+        server.connect()
+        thread = threading.Thread(target=server.run)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+
+        client = Text2SpeechClient(server_port=server.port)
+        client.connect(max_retry=50, wait_time=0.1)
+        return server, player, client
+
+    def test_streams_the_audio_to_the_player(self):
+        FakeCommunicate.wait_for_player = True
+        server, player, client = self.start_server()
+        self.assertEqual(list(client.read_aloud("Hello there.")),
+                         ['[START READING]', '[FINISH READING]'])
+        self.assertEqual(player.played, [b''.join(FakeCommunicate.CHUNKS)])
+        self.assertEqual(player.streamed, [True])
+
+    # the synthesis is done before the first chunk is even played, so the
+    # audio must be cached even when the stream completes that early
+    def test_caches_the_audio(self):
+        server, player, client = self.start_server()
+        for _ in range(5):
+            list(client.read_aloud("Hello there."))
+
+        self.assertEqual(FakeCommunicate.calls, 1)
+        self.assertEqual(player.played,
+                         [b''.join(FakeCommunicate.CHUNKS)] * 5)
+        stats = server.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (4, 1))
+        self.assertEqual(stats['disk_items'], 1)
+
+    def test_keeps_the_cache_on_disk(self):
+        server, player, client = self.start_server()
+        list(client.read_aloud("Hello there."))
+        self.assertEqual(len(os.listdir(self.cache_dir.name)), 1)
+
+        # a new server finds the audio in the same cache directory
+        server, player, client = self.start_server()
+        list(client.read_aloud("Hello there."))
+        self.assertEqual(FakeCommunicate.calls, 1)
+        self.assertEqual(server.cache.stats()['hits'], 1)
+        self.assertEqual(player.played, [b''.join(FakeCommunicate.CHUNKS)])
+
+    def test_reports_a_failed_synthesis(self):
+        server, player, client = self.start_server()
+        for fail_after in (0, 1):
+            FakeCommunicate.fail_after = fail_after
+            with self.assertRaises(ServiceError):
+                list(client.read_aloud(f"Hello number {fail_after}."))
+        # only the complete audio is played to the end and cached
+        self.assertEqual(player.played, [])
+        self.assertEqual(server.cache.stats()['disk_items'], 0)
+
+        FakeCommunicate.fail_after = None
+        self.assertEqual(list(client.read_aloud("Hello there.")),
+                         ['[START READING]', '[FINISH READING]'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+from statistics import median
+
+# Measures how long it takes to import the front-end and the services,
+# each in a fresh interpreter so nothing is cached between the runs.
+# Run it from the repository root:
+#   python tool/benchmark_import_time.py
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+MODULES = [
+    "service.base",
+    "service.language_model",
+    "service.speech2text",
+    "service.text2speech",
+    "service.action",
+    "service.launcher",
+    "app",
+    "tui",
+]
+
+# none of these should be loaded just by importing the modules above
+HEAVY_MODULES = [
+    "gpt4all", "faster_whisper", "ctranslate2", "pyttsx3", "edge_tts",
+    "playsound", "pyaudio", "keyboard", "textual",
+]
+
+PROBE = '''
+import sys, json, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"elapsed": elapsed, "heavy": heavy}}))
+'''
+
+
+def time_import(module, runs):
+    elapsed, heavy = [], []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c",
+             PROBE.format(module=module, heavy=HEAVY_MODULES)],
+            cwd=REPO_ROOT, capture_output=True, text=True)
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()[-1]
+            return None, error
+        sample = json.loads(result.stdout.strip().splitlines()[-1])
+        elapsed.append(sample["elapsed"])
+        heavy = sample["heavy"]
+    return median(elapsed), heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the import time of the TalkyTalky modules")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="Fresh interpreters to start per module")
+    parser.add_argument("modules", nargs="*", default=MODULES,
+                        help="Modules to import (default: all of them)")
+    args = parser.parse_args()
+
+    for module in args.modules:
+        elapsed, heavy = time_import(module, args.runs)
+        if elapsed is None:
+            print(f"{module:<24} failed: {heavy}")
+            continue
+        loaded = ", ".join(heavy) if heavy else "-"
+        print(f"{module:<24} {elapsed * 1000:8.1f} ms   heavy: {loaded}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+# Benchmarks the socket layer, the request workers and the frame scheduler
+# with deterministic stand-ins for the models, so it runs offline and
+# without a GPU. Run it from the repository root:
+#   python tool/benchmark_services.py
+#   python tool/benchmark_services.py --json > baseline.json
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from service.trace import percentile  # noqa: E402
+from service.action import ActionServer, ActionClient  # noqa: E402
+from service.language_model import LanguageModelServer  # noqa: E402
+from service.language_model import LanguageModelClient  # noqa: E402
+from service.speech2text import Speech2TextServer  # noqa: E402
+from service.speech2text import Speech2TextClient  # noqa: E402
+from service.text2speech import Text2SpeechServerBase  # noqa: E402
+from service.text2speech import Text2SpeechClient  # noqa: E402
+
+
+# An "LLM" answering with the words of the prompt, one token every
+# token_delay seconds
+class EchoModel:
+    def __init__(self, token_delay=0.0):
+        self.token_delay = token_delay
+
+    @contextmanager
+    def chat_session(self):
+        yield
+
+    def generate(self, prompt, temp=0, max_tokens=200, streaming=False,
+                 callback=None):
+        tokens = self._tokens(prompt, callback)
+        return tokens if streaming else ''.join(tokens)
+
+    def _tokens(self, prompt, callback):
+        for token_id, word in enumerate(prompt.split()):
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            yield ' ' + word
+            # like GPT4All, stop when the callback returns False
+            if callback and not callback(token_id, ' ' + word):
+                break
+
+
+# A "Whisper" hearing the same text in any audio after a fixed delay.
+# It claims to be multilingual, so every utterance takes the
+# transcribe() path instead of the batched ctranslate2 one.
+class FixedTextWhisper:
+    def __init__(self, text="hello there", delay=0.0):
+        self.text = text
+        self.delay = delay
+        self.model = SimpleNamespace(is_multilingual=True)
+
+    def transcribe(self, audio, vad_filter=False):
+        if self.delay:
+            time.sleep(self.delay)
+        return [SimpleNamespace(text=self.text)], None
+
+
+# A "TTS" that stays silent, but takes as long to play a sentence as a
+# voice reading words_per_second would
+class SilentTextToSpeech(Text2SpeechServerBase):
+    def __init__(self, words_per_second=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.words_per_second = words_per_second
+
+    def _play(self, audio):
+        if self.words_per_second:
+            time.sleep(len(audio.split()) / self.words_per_second)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start(server):
+    server.connect()
+    thread = threading.Thread(target=server.run)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def connect(client):
+    client.connect(max_retry=50, wait_time=0.1)
+    return client
+
+
+def latency_stats(latencies, elapsed):
+    values = sorted(latencies)
+    return {
+        'requests': len(values),
+        'msgs_per_sec': round(len(values) / elapsed, 1),
+        **{f'rtt_p{q}_ms': round(percentile(values, q) * 1000, 3)
+           for q in (50, 95, 99)},
+    }
+
+
+# every client sends its requests one after another, all clients at once
+def run_clients(clients, request, requests_per_client):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(client):
+        own = []
+        for _ in range(requests_per_client):
+            start_time = time.perf_counter()
+            request(client)
+            own.append(time.perf_counter() - start_time)
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=worker, args=(c,)) for c in clients]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latency_stats(latencies, time.perf_counter() - start_time)
+
+
+@contextmanager
+def memory_usage(result):
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['py_heap_peak_kib'] = round(peak / 1024, 1)
+        try:
+            import resource
+        except ImportError:
+            # not available on Windows
+            return
+        # kilobytes on Linux, bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            maxrss //= 1024
+        result['max_rss_kib'] = maxrss
+
+
+def bench_language_model(args):
+    server = start(LanguageModelServer(
+        model_dir=None, model=EchoModel(args.token_delay),
+        port=free_port()))
+    prompt = ' '.join(['word'] * args.prompt_words)
+    clients = [connect(LanguageModelClient(server_port=server.port))
+               for _ in range(args.clients)]
+
+    results = {}
+    results['text'] = run_clients(
+        clients, lambda c: c.get_answer(prompt), args.requests)
+
+    first_tokens = []
+
+    def stream(client):
+        start_time = time.perf_counter()
+        for index, _ in enumerate(client.stream_answer(prompt)):
+            if index == 0:
+                first_tokens.append(time.perf_counter() - start_time)
+
+    results['stream'] = run_clients(clients, stream, args.requests)
+    results['stream']['first_token_p50_ms'] = round(
+        percentile(sorted(first_tokens), 50) * 1000, 3)
+    return results
+
+
+def bench_speech2text(args):
+    server = start(Speech2TextServer(
+        model_dir=None, model=FixedTextWhisper(delay=args.stt_delay),
+        port=free_port()))
+    # one second of silence, sent at once and as a stream of chunks
+    rate = 16000
+    pcm = bytes(2 * rate)
+    chunks = [pcm[i:i + 2048] for i in range(0, len(pcm), 2048)]
+    clients = [connect(Speech2TextClient(server_port=server.port))
+               for _ in range(args.clients)]
+
+    results = {}
+    results['pcm'] = run_clients(
+        clients, lambda c: c.get_text_from_pcm(pcm, rate, 1), args.requests)
+    results['pcm_stream'] = run_clients(
+        clients, lambda c: c.get_text_from_pcm_stream(iter(chunks), rate, 1),
+        args.requests)
+    return results
+
+
+def bench_text2speech(args):
+    server = start(SilentTextToSpeech(port=free_port()))
+    text = "The quick brown fox. Jumps over the lazy dog. " * 2
+    clients = [connect(Text2SpeechClient(server_port=server.port))
+               for _ in range(args.clients)]
+
+    return {'read_aloud': run_clients(
+        clients, lambda c: list(c.read_aloud(text)), args.requests)}
+
+
+def bench_action(args):
+    # a local receiver stands in for VSeeFace and measures the frame rate
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(0.5)
+    arrivals = []
+    receiving = threading.Event()
+    receiving.set()
+
+    def receive():
+        while receiving.is_set():
+            try:
+                receiver.recv(4096)
+            except socket.timeout:
+                continue
+            arrivals.append(time.perf_counter())
+
+    receive_thread = threading.Thread(target=receive)
+    receive_thread.daemon = True
+    receive_thread.start()
+
+    tts_server = start(SilentTextToSpeech(
+        words_per_second=args.words_per_second, port=free_port()))
+    server = start(ActionServer(
+        action_fps=args.fps, tts_server_port=tts_server.port,
+        openseeface_targets=[receiver.getsockname()], port=free_port()))
+    client = connect(ActionClient(server_port=server.port))
+
+    # the avatar keeps idling, then speaks a few sentences in a row
+    time.sleep(args.idle_time)
+    # every reaction is played in real time, so keep them few
+    results = {'react_to': run_clients(
+        [client], lambda c: c.react_to("Hello there. How are you today?"),
+        min(args.requests, 5))}
+    receiving.clear()
+    receive_thread.join()
+    receiver.close()
+
+    intervals = sorted(b - a for a, b in zip(arrivals, arrivals[1:]))
+    expected = 1 / args.fps
+    results['frames'] = {
+        **server.frame_stats.summary(),
+        'received': len(arrivals),
+        **{f'interval_p{q}_ms': round(percentile(intervals, q) * 1000, 3)
+           for q in (50, 95, 99)},
+        'late_frames': sum(i > 1.5 * expected for i in intervals),
+    }
+    return results
+
+
+BENCHMARKS = {
+    'language_model': bench_language_model,
+    'speech2text': bench_speech2text,
+    'text2speech': bench_text2speech,
+    'action': bench_action,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the TalkyTalky services with stand-in models")
+    parser.add_argument("benchmarks", nargs="*",
+                        choices=[[]] + list(BENCHMARKS),
+                        help="Benchmarks to run (default: all of them)")
+    parser.add_argument("--clients", type=int, default=4,
+                        help="Concurrent clients per server")
+    parser.add_argument("--requests", type=int, default=50,
+                        help="Requests sent by every client")
+    parser.add_argument("--prompt-words", type=int, default=32,
+                        help="Words in the prompt, i.e. tokens of the answer")
+    parser.add_argument("--token-delay", type=float, default=0.0,
+                        help="Seconds the echo LLM takes per token")
+    parser.add_argument("--stt-delay", type=float, default=0.0,
+                        help="Seconds the fixed-text Whisper takes per call")
+    parser.add_argument("--fps", type=int, default=24,
+                        help="Frame rate of the ActionServer")
+    parser.add_argument("--words-per-second", type=float, default=20.0,
+                        help="Reading speed of the silent TTS")
+    parser.add_argument("--idle-time", type=float, default=1.0,
+                        help="Seconds the avatar idles before it speaks")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the results as JSON")
+    parser.add_argument("--server-log", action="store_true",
+                        help="Print the log of the servers to stderr")
+    args = parser.parse_args()
+    if not args.benchmarks:
+        args.benchmarks = list(BENCHMARKS)
+
+    # the servers keep logging until the process exits
+    out = sys.stdout
+    sys.stdout = sys.stderr if args.server_log else open(os.devnull, 'w')
+
+    results = {}
+    for name in args.benchmarks:
+        result = {}
+        with memory_usage(result):
+            result.update(BENCHMARKS[name](args))
+        results[name] = result
+
+    if args.json:
+        print(json.dumps(results, indent=2), file=out)
+        return
+    for name, result in results.items():
+        print(f"== {name}", file=out)
+        for key, value in result.items():
+            if isinstance(value, dict):
+                value = '  '.join(f"{k}={v}" for k, v in value.items())
+            print(f"  {key:<12} {value}", file=out)
+
+
+if __name__ == "__main__":
+    main()
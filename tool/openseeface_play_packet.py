@@ -1,20 +1,22 @@
+import mmap
 import socket
 import time
 
 UDP_IP = "127.0.0.1"  # Replace with the IP address of the UDP server
 UDP_PORT = 11573  # Replace with the port number the UDP server is listening on
 
-# Open the binary file for reading
+FRAME_LEN = 1785  # One OpenSeeFace frame is 1785 bytes
+
+# Map the binary file into memory instead of reading it
 file_path = "received_data.bin"  # Replace with the path to your binary file
-frames = []
 
 with open(file_path, "rb") as file:
-    while True:
-        frame = file.read(1785)  # Read one frame (1785 bytes) from the binary file
-        if not frame:
-            break  # End of file
+    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
 
-        frames.append(frame)
+# Every frame is a view into the mapped file, no bytes are copied
+view = memoryview(data)
+frames = [view[offset:offset + FRAME_LEN]
+          for offset in range(0, len(view) - FRAME_LEN + 1, FRAME_LEN)]
 
 # Create a UDP socket and send each frame in the list
 sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -0,0 +1,284 @@
+import time
+import uuid
+import threading
+from statistics import mean
+
+import pyaudio
+from textual import on, work
+from textual.validation import Length
+from textual.app import App, ComposeResult
+from textual.widgets import Header, Footer
+from textual.widgets import Input, RichLog, LoadingIndicator, Button, Sparkline
+from textual.widgets import Static
+
+from service import trace
+from service.audio import convert_pcm16, open_input_stream
+from service.action import ActionClient
+from service.language_model import LanguageModelClient
+from service.speech2text import Speech2TextClient
+from service.launcher import start_services, wait_for_services
+
+
+class TalkyTalkyTUI(App):
+    CSS = '''
+Screen {
+    layout: vertical;
+    layers: below above;
+    align: center middle;
+}
+
+RichLog {
+    layer: below;
+    height: 0.7fr;
+    border: round darkgreen;
+    background: green 10%;
+    margin: 1;
+}
+
+RichLog:focus {
+    border: round green;
+    background: green 15%;
+}
+
+#answer_box {
+    layer: below;
+    height: auto;
+    max-height: 0.3fr;
+    display: none;
+    border: round green;
+    background: green 10%;
+    margin: 0 1;
+}
+
+#prompt_box {
+    layer: below;
+    height: 0.2fr;
+    border: round darkblue;
+    background: blue 10%;
+    margin: 1;
+}
+
+#prompt_box:focus {
+    border: round blue;
+    background: blue 15%;
+}
+
+Button {
+    layer: below;
+    height: 0.1fr;
+    width: 1fr;
+    margin: 2;
+    min-height: 1;
+}
+
+#start_record {
+    display: block;
+}
+
+#stop_record {
+    display: none;
+}
+
+LoadingIndicator {
+    layer: above;
+    height: 10%;
+    width: 30%;
+    margin: 2;
+    padding: 1;
+    min-height: 3;
+    display: none;
+    content-align: center middle;
+}
+
+#processing_chat {
+    color: $accent;
+    border: $accent round;
+}
+
+#processing_record {
+    color: $warning;
+    border: $warning round;
+}
+
+Sparkline {
+    layer: above;
+    height: 10%;
+    width: 30%;
+    margin: 2;
+    padding: 1;
+    min-height: 3;
+    display: none;
+    border: $warning round;
+    content-align: center middle;
+}
+
+Sparkline > .sparkline--max-color {
+    color: $error;
+}
+
+Sparkline > .sparkline--min-color {
+    color: $warning;
+}
+'''
+
+    BINDINGS = [("d", "toggle_dark", "Toggle dark mode"),
+                ("escape", "cancel", "Stop answering"),
+                ("q", "quit", "Quit")]
+
+    def __init__(self, app_cfg):
+        self.app_cfg = app_cfg
+        self.services = start_services(self.app_cfg)
+        trace.configure(self.app_cfg.trace_file)
+        self.tracer = trace.Tracer(self.__class__.__name__)
+
+        self.speech2text_client = Speech2TextClient()
+        self.language_model_client = LanguageModelClient()
+        self.action_client = ActionClient()
+
+        wait_for_services(self.services, {
+            'speech2text': self.speech2text_client,
+            'language_model': self.language_model_client,
+            'action': self.action_client,
+        })
+        # the server keeps the chat history under this id, see SessionStore
+        self.language_model_client.use_session(uuid.uuid4().hex)
+
+        self.mutex_on_submit = threading.Lock()
+
+        self.is_recording = False
+        self.voice_turn_id = None
+        # the turns whose answers are being generated or read aloud
+        self.answering_turn_ids = set()
+        self.chunk = 1024
+        self.channels = self.app_cfg.audio_channels
+        self.fs = self.app_cfg.audio_rate
+        self.audio = pyaudio.PyAudio()
+        self.stream, self.capture_fs, self.capture_channels = \
+            open_input_stream(self.audio, self.fs, self.channels, self.chunk)
+        super().__init__()
+
+    def compose(self) -> ComposeResult:
+        yield Header()
+        yield Footer()
+        yield RichLog(wrap=True, highlight=True, markup=True)
+        yield Static(id="answer_box")
+        yield Input(id="prompt_box",
+                    placeholder="Write your prompt here. Press ENTER to send.",
+                    validate_on=["changed", "submitted"],
+                    validators=[Length(minimum=1, failure_description="Your prompt must not be empty.")]).focus()
+        yield Button(label="SPEECH TO TEXT", id="start_record")
+        yield Button(label="FINISH SPEAKING", id="stop_record", variant='warning')
+        yield LoadingIndicator(id="processing_chat")
+        yield LoadingIndicator(id="processing_record")
+        yield Sparkline(data=[], summary_function=mean)
+
+    def action_toggle_dark(self) -> None:
+        """An action to toggle dark mode."""
+        self.dark = not self.dark
+
+    def action_cancel(self) -> None:
+        """An action to stop generating and reading the answers."""
+        for turn_id in list(self.answering_turn_ids):
+            # the action server passes it on to the text-to-speech server
+            self.language_model_client.cancel(turn_id)
+            self.action_client.cancel(turn_id)
+
+    # TODO: After I add id="#prompt_box", input_box.action_submit() does not trigger submit_prompt(), why?
+    # @on(Input.Submitted, "#prompt_box")
+    @on(Input.Submitted)
+    @work(exclusive=True, thread=True)
+    def submit_prompt(self, event: Input.Submitted) -> None:
+        if self.mutex_on_submit.acquire(blocking=False):
+            if event.validation_result.is_valid:
+                loading_box = self.query_one("#processing_chat")
+                loading_box.display = True
+                chat_box = self.query_one(RichLog)
+
+                me = '[bold red]ME  >> [/bold red]'
+                her = '[bold green]BOT >> [/bold green]'
+                prompt = event.value
+                chat_box.write(me + prompt)
+                self.query_one("#prompt_box").value = ''
+
+                # show the answer token by token as soon as it is generated,
+                # which is after the answers to the previous prompts
+                def show_answer(turn_id):
+                    self.language_model_client.begin_turn(turn_id)
+                    answer = ''
+                    answer_box = self.query_one("#answer_box")
+                    answer_box.update(her)
+                    for token in self.language_model_client.stream_answer(
+                            prompt):
+                        loading_box.display = False
+                        answer_box.display = True
+                        answer += token
+                        answer_box.update(her + answer)
+                        yield token
+                    answer_box.display = False
+                    chat_box.write(her + answer)
+                    loading_box.display = False
+
+                # a spoken prompt continues the turn of its recording
+                turn_id = self.voice_turn_id or trace.new_turn_id()
+                self.voice_turn_id = None
+                self.action_client.begin_turn(turn_id)
+                self.answering_turn_ids.add(turn_id)
+                start = time.perf_counter()
+
+                def end_turn(future):
+                    self.answering_turn_ids.discard(turn_id)
+                    self.tracer.record('turn', turn_id, start)
+
+                # make reaction to the answer while it is being generated;
+                # the next prompt can be sent while the answer is read
+                self.action_client.react_to_async(
+                    show_answer(turn_id), on_done=end_turn)
+
+            self.mutex_on_submit.release()
+
+    @on(Button.Pressed, "#start_record")
+    @work(exclusive=True, thread=True)
+    async def start_record(self):
+        if not self.is_recording:
+            # talking while the bot answers interrupts it (barge-in)
+            self.action_cancel()
+            self.is_recording = True
+            self.query_one("#start_record").display = False
+            self.query_one("#stop_record").display = True
+
+            sparkline = self.query_one(Sparkline)
+            input_box = self.query_one("#prompt_box")
+            loading_box = self.query_one("#processing_record")
+
+            def record():
+                self.stream.start_stream()
+                sparkline.display = True
+                while self.is_recording:
+                    data = self.stream.read(self.chunk)
+                    sparkline.data = data
+                    yield convert_pcm16(data,
+                                        self.capture_fs, self.capture_channels,
+                                        self.fs, self.channels)
+                self.stream.stop_stream()
+                sparkline.display = False
+                loading_box.display = True
+
+            self.voice_turn_id = trace.new_turn_id()
+            self.speech2text_client.begin_turn(self.voice_turn_id)
+
+            # speech to text while the user is still speaking
+            prompt = self.speech2text_client.get_text_from_pcm_stream(
+                record(), self.fs, self.channels)
+            input_box.value = prompt
+
+            loading_box.display = False
+            self.query_one("#stop_record").display = False
+            self.query_one("#start_record").display = True
+            input_box.focus()
+
+            await input_box.action_submit()
+
+    @on(Button.Pressed, "#stop_record")
+    def stop_record(self):
+        if self.is_recording:
+            self.is_recording = False